@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# Measures how long an adapter's poll takes as more adapters are registered.
+#
+# Polls go through the Quart test client, so this covers routing and the request hooks
+# as well as looking the adapter up in the store. A lookup by scanning every adapter is
+# timed alongside for comparison. Poll latency should stay flat as adapters are added.
+#
+# Usage: scripts-dev/bench-adapter-poll.py [--polls N] [adapter counts...]
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+from typing import List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from quart import Quart  # noqa: E402
+
+from trafficlight.http import adapter as adapter_api  # noqa: E402
+from trafficlight.internals.adapter import Adapter  # noqa: E402
+from trafficlight.store import add_adapter, get_adapters  # noqa: E402
+
+SCANS = 2000
+
+
+def scan_for_adapter(guid: str) -> Optional[Adapter]:
+    for adapter in get_adapters():
+        if adapter.guid == guid:
+            return adapter
+    return None
+
+
+async def run(adapter_counts: List[int], polls: int) -> None:
+    app = Quart("trafficlight")
+    app.register_blueprint(adapter_api.bp)
+    client = app.test_client()
+
+    registered = 0
+    print("  adapters   poll latency   lookup by scanning")
+    for count in sorted(adapter_counts):
+        while registered < count:
+            add_adapter(
+                Adapter(f"bench{registered}", {"type": "element-web", "version": "1"})
+            )
+            registered += 1
+        # The most recently registered adapter is the worst case for a scan.
+        guid = f"bench{count - 1}"
+
+        started = time.perf_counter()
+        for _ in range(polls):
+            await client.get(f"/client/{guid}/poll")
+        poll_latency = (time.perf_counter() - started) / polls
+
+        started = time.perf_counter()
+        for _ in range(SCANS):
+            scan_for_adapter(guid)
+        scan_latency = (time.perf_counter() - started) / SCANS
+
+        print(f"{count:10d} {poll_latency * 1e6:12.1f}us {scan_latency * 1e6:18.1f}us")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure adapter poll latency as more adapters are registered."
+    )
+    parser.add_argument(
+        "adapter_counts",
+        metavar="COUNT",
+        type=int,
+        nargs="*",
+        default=[10, 100, 1000, 10000],
+        help="numbers of registered adapters to measure polling with",
+    )
+    parser.add_argument(
+        "--polls", type=int, default=300, help="polls to time for each count"
+    )
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(args.adapter_counts, args.polls))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from trafficlight.internals.client import Client
+
+
+class QueuedActionsTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        test_case = SimpleNamespace(guid="test_case", action_timings=[])
+        self.client = Client("alice", test_case, {"type": "element-web"})
+
+    async def test_flush_waits_for_queued_actions(self) -> None:
+        first = self.client.queue_action({"action": "one", "data": {}})
+        second = self.client.queue_action({"action": "two", "data": {}})
+        flush = asyncio.create_task(self.client.flush_actions())
+
+        self.client._give_poll_response({"id": "1", "response": "ok"})
+        self.client._give_poll_response({"id": "2", "response": "ok"})
+        await flush
+
+        self.assertEqual((await first)["response"], "ok")
+        self.assertEqual((await second)["response"], "ok")
+
+    async def test_flush_raises_a_failure_once(self) -> None:
+        self.client.queue_action({"action": "one", "data": {}})
+        flush = asyncio.create_task(self.client.flush_actions())
+        await asyncio.sleep(0)
+
+        failure = Exception("adapter failed")
+        self.client._give_poll_exception(failure)
+
+        with self.assertRaises(Exception) as raised:
+            await flush
+        self.assertIs(raised.exception, failure)
+        # Already raised by the flush, so the next action goes ahead.
+        self.assertIsNone(self.client.next_exception)
+        self.client.queue_action({"action": "two", "data": {}})
+
+    async def test_failure_without_a_flush_is_raised_by_the_next_action(self) -> None:
+        self.client.queue_action({"action": "one", "data": {}})
+        failure = Exception("adapter failed")
+        self.client._give_poll_exception(failure)
+
+        with self.assertRaises(Exception) as raised:
+            self.client.queue_action({"action": "two", "data": {}})
+        self.assertIs(raised.exception, failure)
@@ -0,0 +1,168 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import unittest
+from datetime import timedelta
+from typing import Any, Dict, List
+
+from aiohttp import web
+
+from trafficlight.homerunner import HomerunnerClient, HomerunnerError
+from trafficlight.server_types import SynapseDevelop, TwoSynapseFederation
+
+
+class FakeHomerunner(object):
+    """
+    Answers /create and /destroy like homerunner, with homeservers that are always ready.
+    """
+
+    def __init__(self) -> None:
+        self.created: List[str] = []
+        self.destroyed: List[str] = []
+        self.url = ""
+        self._runner = web.AppRunner(self._app())
+
+    def _app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/create", self._create)
+        app.router.add_post("/destroy", self._destroy)
+        app.router.add_get("/{server}/_matrix/client/versions", self._versions)
+        return app
+
+    async def start(self) -> None:
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    async def _create(self, request: web.Request) -> web.Response:
+        blueprint: Dict[str, Any] = (await request.json())["blueprint"]
+        self.created.append(blueprint["Name"])
+        return web.json_response(
+            {
+                "homeservers": {
+                    homeserver["Name"]: {"BaseURL": f"{self.url}/{homeserver['Name']}"}
+                    for homeserver in blueprint["Homeservers"]
+                }
+            }
+        )
+
+    async def _destroy(self, request: web.Request) -> web.Response:
+        self.destroyed.append((await request.json())["blueprint_name"])
+        return web.json_response({})
+
+    async def _versions(self, request: web.Request) -> web.Response:
+        return web.json_response({"versions": ["v1.1"]})
+
+
+class HomerunnerClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.homerunner = FakeHomerunner()
+        await self.homerunner.start()
+
+    async def asyncTearDown(self) -> None:
+        await self.homerunner.stop()
+
+    async def _client(self, **kwargs: Any) -> HomerunnerClient:
+        client = HomerunnerClient(self.homerunner.url, {}, **kwargs)
+        self.addAsyncCleanup(client.close)
+        return client
+
+    async def _settle(self, client: HomerunnerClient) -> None:
+        # Wait for deployments being created or torn down in the background.
+        while client._background_tasks:
+            await asyncio.wait(set(client._background_tasks))
+
+    async def test_create_without_pool(self) -> None:
+        client = await self._client()
+
+        homeservers = await client.create("test1", SynapseDevelop())
+
+        self.assertEqual(self.homerunner.created, ["test1"])
+        self.assertEqual(len(homeservers), 1)
+        self.assertEqual(homeservers[0].blueprint_name, "test1")
+        self.assertTrue(homeservers[0].cs_api.startswith(self.homerunner.url))
+
+    async def test_warm_deployment_is_handed_out(self) -> None:
+        client = await self._client(pool_sizes={"SynapseDevelop": 1})
+
+        client.fill_pool([SynapseDevelop()])
+        await self._settle(client)
+        self.assertEqual(
+            self.homerunner.created, ["trafficlight-pool-SynapseDevelop-1"]
+        )
+        self.assertEqual(client.pool_status()["SynapseDevelop"]["ready"], 1)
+
+        homeservers = await client.create("test1", SynapseDevelop())
+
+        # Handed the warm deployment rather than creating another.
+        self.assertEqual(len(self.homerunner.created), 1)
+        self.assertEqual(
+            homeservers[0].blueprint_name, "trafficlight-pool-SynapseDevelop-1"
+        )
+        self.assertEqual(client.pool_status()["SynapseDevelop"]["ready"], 0)
+
+    async def test_pool_is_only_filled_for_waiting_test_cases(self) -> None:
+        client = await self._client(pool_sizes={"SynapseDevelop": 3})
+
+        client.fill_pool([SynapseDevelop(), SynapseDevelop()])
+        await self._settle(client)
+        client.fill_pool([SynapseDevelop(), SynapseDevelop()])
+        await self._settle(client)
+
+        self.assertEqual(len(self.homerunner.created), 2)
+
+    async def test_expired_deployment_falls_back_to_create(self) -> None:
+        client = await self._client(
+            pool_sizes={"SynapseDevelop": 1}, pool_max_age=timedelta(0)
+        )
+        client.fill_pool([SynapseDevelop()])
+        await self._settle(client)
+
+        homeservers = await client.create("test1", SynapseDevelop())
+        await self._settle(client)
+
+        self.assertEqual(homeservers[0].blueprint_name, "test1")
+        self.assertEqual(
+            self.homerunner.created, ["trafficlight-pool-SynapseDevelop-1", "test1"]
+        )
+        self.assertEqual(
+            self.homerunner.destroyed, ["trafficlight-pool-SynapseDevelop-1"]
+        )
+
+    async def test_close_tears_down_unused_deployments(self) -> None:
+        client = HomerunnerClient(
+            self.homerunner.url, {}, pool_sizes={"SynapseDevelop": 1}
+        )
+        client.fill_pool([SynapseDevelop()])
+        await self._settle(client)
+
+        await client.close()
+
+        self.assertEqual(
+            self.homerunner.destroyed, ["trafficlight-pool-SynapseDevelop-1"]
+        )
+        self.assertEqual(client.capacity_used, 0)
+
+    async def test_capacity_too_small_for_a_server_type_is_rejected(self) -> None:
+        client = await self._client(capacity=1)
+
+        client.check_capacity([SynapseDevelop()])
+        with self.assertRaises(HomerunnerError):
+            client.check_capacity([SynapseDevelop(), TwoSynapseFederation()])
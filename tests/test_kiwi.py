@@ -0,0 +1,253 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+from socketserver import ThreadingMixIn
+from typing import Any, Callable, Dict, List, Tuple
+from unittest import mock
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+import trafficlight.kiwi as kiwi
+from trafficlight.client_types import ElementAndroid, ElementWebStable
+from trafficlight.internals.test import Test
+from trafficlight.internals.testcase import TestCase, TestCaseState
+from trafficlight.server_types import SynapseDevelop
+
+PASSED = 4
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ("/xml-rpc/",)
+
+
+class _Server(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class FakeKiwi(object):
+    """
+    Answers the XML-RPC calls the Kiwi backend makes, taking latency seconds over each one.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        # How many more TestExecution.update calls to fail, eg while Kiwi is down.
+        self.failing_updates = 0
+        self.calls: Dict[str, int] = {}
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.cases: Dict[str, Dict[str, Any]] = {}
+        self.updates: List[Tuple[int, int]] = []
+        self.run_finished = False
+        self._lock = threading.Lock()
+        self._server = _Server(
+            ("127.0.0.1", 0),
+            requestHandler=_RequestHandler,
+            allow_none=True,
+            logRequests=False,
+        )
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/xml-rpc/"
+
+        self._register("Auth.login", lambda username, password: "session")
+        for model in ("Product", "Version", "Build", "TestPlan", "TestRun"):
+            self._register(f"{model}.create", lambda values: {"id": 1})
+        # One of everything, with the fields the backend looks at.
+        record = {"id": 1, "author": 1, "plan": 1, "product": 1, "product__name": "p"}
+        for model in ("Product", "Version", "Build", "Category", "Priority"):
+            self._register(f"{model}.filter", lambda query: [record])
+        for model in ("PlanType", "Classification", "TestCaseStatus"):
+            self._register(f"{model}.filter", lambda query: [record])
+        # Runs and plans are only found by id, so new ones are created.
+        self._register("TestRun.filter", lambda query: [record] if query else [])
+        self._register(
+            "TestPlan.filter",
+            lambda query: [record] if query.get("pk") else [],
+        )
+        self._register(
+            "TestExecutionStatus.filter",
+            lambda query: [{"id": {"PASSED": PASSED}.get(query["name"], 9)}],
+        )
+        self._register("TestRun.update", self._finish_run)
+        self._register("TestCase.filter", self._filter_cases)
+        self._register("TestCase.create", self._create_case)
+        self._register("TestPlan.add_case", lambda plan_id, case_id: None)
+        self._register(
+            "TestRun.add_case",
+            lambda run_id, case_id: [{"id": case_id * 10, "case": case_id}],
+        )
+        self._register("TestExecution.update", self._update_execution)
+        self._register("TestExecution.add_comment", lambda execution_id, comment: None)
+
+    def start(self) -> None:
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _register(self, name: str, function: Callable[..., Any]) -> None:
+        def call(*args: Any) -> Any:
+            with self._lock:
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.concurrent += 1
+                self.max_concurrent = max(self.max_concurrent, self.concurrent)
+            try:
+                time.sleep(self.latency)
+                return function(*args)
+            finally:
+                with self._lock:
+                    self.concurrent -= 1
+
+        self._server.register_function(call, name)
+
+    def _finish_run(self, run_id: int, values: Dict[str, Any]) -> None:
+        self.run_finished = True
+
+    def _filter_cases(self, query: Dict[str, Any]) -> List[Dict[str, Any]]:
+        with self._lock:
+            case = self.cases.get(query.get("summary", ""))
+            return [case] if case else []
+
+    def _create_case(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        with self._lock:
+            case = {"id": len(self.cases) + 100}
+            self.cases[values["summary"]] = case
+            return case
+
+    def _update_execution(self, execution_id: int, values: Dict[str, Any]) -> None:
+        with self._lock:
+            if self.failing_updates > 0:
+                self.failing_updates -= 1
+                raise Exception("Kiwi is down")
+            self.updates.append((execution_id, values["status"]))
+
+
+class ManyClients(Test):
+    def __init__(self) -> None:
+        super().__init__()
+        self._client_under_test([ElementWebStable(), ElementAndroid()], "alice")
+        self._client_under_test([ElementWebStable(), ElementAndroid()], "bob")
+        self._server_under_test(SynapseDevelop(), ["server"])
+
+
+def _finish(test_case: TestCase) -> None:
+    test_case.adapters = {}
+    for state in (
+        TestCaseState.PREPARING,
+        TestCaseState.RUNNING,
+        TestCaseState.SUCCESS,
+    ):
+        test_case.set_state(state)
+
+
+class KiwiClientTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.kiwi = FakeKiwi(latency=0.02)
+        self.kiwi.start()
+        self.addCleanup(self.kiwi.stop)
+
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        with open(os.path.join(home.name, ".tcms.conf"), "w") as config:
+            config.write(f"[tcms]\nurl = {self.kiwi.url}\nusername = u\npassword = p\n")
+        environment = mock.patch.dict(
+            os.environ,
+            {
+                "HOME": home.name,
+                "TCMS_PRODUCT": "trafficlight",
+                "TCMS_PRODUCT_VERSION": "1",
+                "TCMS_BUILD": "1",
+            },
+        )
+        environment.start()
+        self.addCleanup(environment.stop)
+        self.spool_path = os.path.join(home.name, "spool.jsonl")
+        retry_delay = mock.patch.object(kiwi, "KIWI_RETRY_INITIAL_DELAY", 0.01)
+        retry_delay.start()
+        self.addCleanup(retry_delay.stop)
+
+        self.test_cases = ManyClients().generate_test_cases()
+        get_tests = mock.patch(
+            "trafficlight.store.get_tests", return_value=self.test_cases
+        )
+        get_tests.start()
+        self.addCleanup(get_tests.stop)
+
+        self.client = kiwi.KiwiClient(False, kiwi.Spool(self.spool_path))
+
+    async def _report_all(self) -> None:
+        await self.client.start_run()
+        for test_case in self.test_cases:
+            _finish(test_case)
+            self.client.report_status(test_case)
+
+    async def test_results_are_uploaded_concurrently(self) -> None:
+        await self._report_all()
+        await self.client.end_run()
+
+        self.assertEqual(len(self.kiwi.updates), len(self.test_cases))
+        self.assertTrue(all(status == PASSED for _, status in self.kiwi.updates))
+        self.assertGreater(self.kiwi.max_concurrent, 1)
+        self.assertLessEqual(self.kiwi.max_concurrent, kiwi.KIWI_RPC_CONCURRENCY)
+        self.assertTrue(self.kiwi.run_finished)
+        self.assertEqual(self.client.spool.pending, {})
+
+    async def test_test_cases_are_registered_once(self) -> None:
+        await self._report_all()
+        await self.client.end_run()
+
+        # Executions are cached by summary when the run starts, so uploading doesn't register again.
+        self.assertEqual(self.kiwi.calls["TestRun.add_case"], len(self.test_cases))
+        self.assertEqual(
+            set(self.client._executions.keys()),
+            {kiwi.summarize_test_case(test_case) for test_case in self.test_cases},
+        )
+
+    async def test_failed_uploads_are_retried(self) -> None:
+        self.kiwi.failing_updates = 3
+        await self._report_all()
+        await self.client.end_run()
+
+        self.assertEqual(len(self.kiwi.updates), len(self.test_cases))
+        self.assertEqual(self.client.spool.pending, {})
+
+    async def test_end_run_gives_up_after_timeout(self) -> None:
+        self.kiwi.failing_updates = 1000
+        loop = asyncio.get_running_loop()
+        with mock.patch.object(kiwi, "KIWI_END_RUN_TIMEOUT", 0.5):
+            await self._report_all()
+            started = loop.time()
+            await self.client.end_run()
+
+        self.assertLess(loop.time() - started, 2.0)
+        self.assertFalse(self.kiwi.run_finished)
+        # Everything is left in the spool to be replayed later.
+        self.assertEqual(len(self.client.spool.pending), len(self.test_cases))
+        self.assertEqual(len(kiwi.Spool(self.spool_path).pending), len(self.test_cases))
+
+    async def test_results_reported_after_end_run_are_kept(self) -> None:
+        await self.client.start_run()
+        await self.client.end_run()
+
+        # Eg a test case failed by shutdown after the run was closed.
+        test_case = self.test_cases[0]
+        _finish(test_case)
+        self.client.report_status(test_case)
+
+        self.assertEqual(len(kiwi.Spool(self.spool_path).pending), 1)
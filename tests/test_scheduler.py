@@ -0,0 +1,182 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+from typing import Any, Dict, List, Tuple
+
+from trafficlight.client_types import (
+    ClientType,
+    ElementAndroid,
+    ElementWebDevelop,
+    ElementWebStable,
+)
+from trafficlight.internals.adapter import Adapter, AdapterPool
+from trafficlight.internals.test import Test
+from trafficlight.internals.testcase import TestCase
+from trafficlight.scheduler import (
+    ADAPTERS_ALLOCATED,
+    NO_FREE_ADAPTER,
+    AdapterMatching,
+    plan,
+)
+from trafficlight.server_types import SynapseDevelop
+
+
+class ElementWebVersionOne(ClientType):
+    # Only runs on element-web adapters registered with version "1"; see VersionPinningPool.
+    adapter_type = "element-web@1"
+
+
+class VersionPinningPool(AdapterPool):
+    """
+    An AdapterPool where an adapter type of "type@version" only matches that version's bucket.
+
+    The shipped client types accept every version of their adapter type, so a client's
+    candidate buckets are never a subset of another's; pinning one lets a test case need
+    a bucket that an already accepted test case is using.
+    """
+
+    def bucket_keys(self, adapter_type: str) -> List[Tuple[str, str]]:
+        adapter_type, _, version = adapter_type.partition("@")
+        keys = super().bucket_keys(adapter_type)
+        if version:
+            return [key for key in keys if key[1] == version]
+        return keys
+
+
+class Clients(Test):
+    def __init__(self, clients: Dict[str, ClientType]) -> None:
+        super().__init__()
+        for name, client_type in clients.items():
+            self._client_under_test([client_type], name)
+        self._server_under_test(SynapseDevelop(), ["server"])
+
+
+def _test_case(**clients: ClientType) -> TestCase:
+    return Clients(clients).generate_test_cases()[0]
+
+
+def _adapter(guid: str, adapter_type: str, version: str) -> Adapter:
+    return Adapter(guid, {"type": adapter_type, "version": version})
+
+
+def _snapshot(matching: AdapterMatching) -> Tuple[Any, ...]:
+    return (
+        dict(matching._assignment),
+        dict(matching._free),
+        {key: list(slots) for key, slots in matching._slots.items()},
+        list(matching.test_cases),
+    )
+
+
+class AdapterMatchingTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.web1 = _adapter("web1", "element-web", "1")
+        self.web2 = _adapter("web2", "element-web", "2")
+        self.pool = VersionPinningPool([self.web1, self.web2])
+        self.matching = AdapterMatching(self.pool)
+        # Matched to the first bucket for its type, ie version 1.
+        self.any_version = _test_case(alice=ElementWebStable())
+        self.assertTrue(self.matching.add(self.any_version))
+        self.assertEqual(
+            self.matching.allocation(self.any_version), {"alice": self.web1}
+        )
+
+    def test_accepted_test_case_moves_to_admit_another(self) -> None:
+        pinned = _test_case(alice=ElementWebVersionOne())
+
+        self.assertTrue(self.matching.add(pinned))
+
+        self.assertEqual(self.matching.allocation(pinned), {"alice": self.web1})
+        self.assertEqual(
+            self.matching.allocation(self.any_version), {"alice": self.web2}
+        )
+
+    def test_fits_leaves_matching_unchanged(self) -> None:
+        before = _snapshot(self.matching)
+
+        # Fitting this one needs the accepted test case to move.
+        self.assertTrue(self.matching.fits(_test_case(alice=ElementWebVersionOne())))
+        self.assertEqual(_snapshot(self.matching), before)
+
+        self.assertFalse(
+            self.matching.fits(
+                _test_case(alice=ElementWebVersionOne(), bob=ElementWebVersionOne())
+            )
+        )
+        self.assertEqual(_snapshot(self.matching), before)
+        self.assertEqual(
+            self.matching.allocation(self.any_version), {"alice": self.web1}
+        )
+
+    def test_multi_client_test_case_is_rolled_back(self) -> None:
+        before = _snapshot(self.matching)
+        # alice can be placed by moving the accepted test case, but there is no adapter for bob.
+        test_case = _test_case(alice=ElementWebVersionOne(), bob=ElementAndroid())
+
+        self.assertFalse(self.matching.add(test_case))
+
+        self.assertEqual(_snapshot(self.matching), before)
+        self.assertEqual(
+            self.matching.allocation(self.any_version), {"alice": self.web1}
+        )
+        # The released bucket is free to use again.
+        self.assertTrue(self.matching.add(_test_case(alice=ElementWebStable())))
+
+
+class PlanTest(unittest.TestCase):
+    def test_overlapping_client_types_get_separate_adapters(self) -> None:
+        stable = _adapter("stable", "element-web", "stable")
+        develop = _adapter("develop", "element-web", "develop")
+        test_case = _test_case(alice=ElementWebStable(), bob=ElementWebDevelop())
+
+        result = plan([test_case], AdapterPool([stable, develop]))
+
+        self.assertEqual(len(result.allocations), 1)
+        allocated_test_case, adapters = result.allocations[0]
+        self.assertIs(allocated_test_case, test_case)
+        self.assertEqual(set(adapters.values()), {stable, develop})
+        self.assertEqual(result.unplaced, {})
+
+    def test_overlapping_client_types_need_an_adapter_each(self) -> None:
+        test_case = _test_case(alice=ElementWebStable(), bob=ElementWebDevelop())
+
+        result = plan([test_case], AdapterPool([_adapter("web", "element-web", "1")]))
+
+        self.assertEqual(result.allocations, [])
+        self.assertEqual(result.unplaced, {test_case: ADAPTERS_ALLOCATED})
+
+    def test_missing_adapter_type_is_reported(self) -> None:
+        test_case = _test_case(alice=ElementWebStable(), bob=ElementAndroid())
+
+        result = plan([test_case], AdapterPool([_adapter("web", "element-web", "1")]))
+
+        self.assertEqual(result.allocations, [])
+        self.assertEqual(
+            result.unplaced,
+            {test_case: NO_FREE_ADAPTER + " for bob (ElementAndroid)"},
+        )
+        self.assertEqual(result.unplaced_reasons, {NO_FREE_ADAPTER: 1})
+
+    def test_smaller_test_cases_are_placed_first(self) -> None:
+        pair = _test_case(alice=ElementWebStable(), bob=ElementWebDevelop())
+        single = _test_case(alice=ElementWebStable())
+        pool = AdapterPool(
+            [_adapter("web1", "element-web", "1"), _adapter("web2", "element-web", "2")]
+        )
+
+        result = plan([pair, single], pool)
+
+        self.assertEqual([test_case for test_case, _ in result.allocations], [single])
+        self.assertEqual(result.unplaced, {pair: ADAPTERS_ALLOCATED})
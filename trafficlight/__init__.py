@@ -12,6 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 import json
 import logging
 import os
@@ -19,9 +20,13 @@ import uuid
 from datetime import datetime, timedelta
 from typing import Any, Dict, Optional
 
+import click
 from quart import Quart
 
+import trafficlight.events as events
+import trafficlight.junit as junit
 import trafficlight.kiwi as kiwi
+from trafficlight.artifacts import ArtifactStore
 from trafficlight.homerunner import HomerunnerClient
 from trafficlight.http.adapter import (
     adapter_shutdown,
@@ -30,7 +35,12 @@ from trafficlight.http.adapter import (
     loop_cleanup_unresponsive_adapters,
 )
 from trafficlight.internals.testsuite import TestSuite
-from trafficlight.store import add_testsuite, get_testsuites
+from trafficlight.store import (
+    add_testsuite,
+    get_artifacts_in_use,
+    get_state_counts,
+    get_testsuites,
+)
 from trafficlight.tests import load_tests
 
 logger = logging.getLogger(__name__)
@@ -49,6 +59,16 @@ def format_delaytime(value: datetime) -> str:
     )
 
 
+# Format a duration as "2 min 5 sec".
+def format_duration(value: Optional[timedelta]) -> str:
+    if value is None:
+        return "N/A"
+    return "%s min %s sec" % (
+        value // timedelta(minutes=1),
+        int((value % timedelta(minutes=1)).total_seconds()),
+    )
+
+
 def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
     app = Quart(__name__, instance_relative_config=True)
 
@@ -59,8 +79,14 @@ def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
             "UPLOAD_FOLDER": "/tmp/",
             "HOMERUNNER_URL": "http://localhost:4090",
             "SERVER_OVERRIDES": {},
+            "SERVER_OVERRIDES_HEALTH_CHECK": False,
+            "HOMESERVER_POOL_SIZE": {},
+            "HOMESERVER_CAPACITY": 0,
             "KIWI_REPORT": False,
             "KIWI_VERBOSE": True,
+            "KIWI_SPOOL": "/tmp/trafficlight-kiwi-spool.jsonl",
+            "JUNIT_OUTPUT": "",
+            "ARTIFACT_STORE_MAX_BYTES": 2 * 1024 * 1024 * 1024,
         }
     )
 
@@ -72,10 +98,17 @@ def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
 
     # ensure the instance folder exists
     print(f"Test Pattern: {app.config.get('TEST_PATTERN')}")
-    print(f"Upload Folder: {app.config.get('UPLOAD_FOLDER')}")
+    print(
+        f"Upload Folder: {app.config.get('UPLOAD_FOLDER')}, keeping at most {app.config.get('ARTIFACT_STORE_MAX_BYTES') or 'unlimited'} bytes"
+    )
     print(f"Overrides: {app.config.get('SERVER_OVERRIDES')}")
+    print(f"Homeserver Pool: {app.config.get('HOMESERVER_POOL_SIZE')}")
+    print(f"JUnit Output: {app.config.get('JUNIT_OUTPUT') or 'none'}")
+    print(
+        f"Homeserver Capacity: {app.config.get('HOMESERVER_CAPACITY') or 'unlimited'}"
+    )
     print(
-        f"Kiwi: {app.config.get('KIWI_REPORT')}, Verbose: {app.config.get('KIWI_VERBOSE')}, Product Name: {app.config.get('KIWI_PRODUCT_NAME')}, Product Version: {app.config.get('KIWI_PRODUCT_VERSION')}"
+        f"Kiwi: {app.config.get('KIWI_REPORT')}, Spool: {app.config.get('KIWI_SPOOL')}, Verbose: {app.config.get('KIWI_VERBOSE')}, Product Name: {app.config.get('KIWI_PRODUCT_NAME')}, Product Version: {app.config.get('KIWI_PRODUCT_VERSION')}"
     )
 
     loaded_tests = load_tests(
@@ -91,7 +124,9 @@ def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
         add_testsuite(test_suite)
 
     if app.config.get("KIWI_REPORT"):
-        kiwi.kiwi_client = kiwi.KiwiClient(app.config.get("KIWI_VERBOSE"))
+        kiwi.kiwi_client = kiwi.KiwiClient(
+            app.config.get("KIWI_VERBOSE"), kiwi.Spool(app.config["KIWI_SPOOL"])
+        )
         # Screaming quietly for now; i don't want to have more ways to set config options
         # so avoiding env vars coming in from the environment and overriding them from the app configuration.
         # Potentially this is a sign we're not using this API correctly.
@@ -99,19 +134,45 @@ def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
         os.environ["TCMS_PRODUCT_VERSION"] = app.config.get("KIWI_PRODUCT_VERSION")
         os.environ["TCMS_BUILD"] = str(uuid.uuid4())
 
-    from trafficlight.http import adapter, root, status
+    from trafficlight.http import adapter, root, status, status_api
 
     app.register_blueprint(adapter.bp)
     app.register_blueprint(status.bp)
+    app.register_blueprint(status_api.bp)
     app.register_blueprint(root.bp)
 
+    app.config["artifacts"] = ArtifactStore(
+        os.path.join(app.config["UPLOAD_FOLDER"], "trafficlight-artifacts"),
+        app.config["ARTIFACT_STORE_MAX_BYTES"],
+        in_use=get_artifacts_in_use,
+    )
     app.config["homerunner"] = HomerunnerClient(
-        app.config["HOMERUNNER_URL"], app.config["SERVER_OVERRIDES"]
+        app.config["HOMERUNNER_URL"],
+        app.config["SERVER_OVERRIDES"],
+        app.config["HOMESERVER_POOL_SIZE"],
+        capacity=app.config["HOMESERVER_CAPACITY"],
+        check_server_overrides=app.config["SERVER_OVERRIDES_HEALTH_CHECK"],
+    )
+    app.config["homerunner"].check_capacity(
+        [test.server_type for test in loaded_tests if test.server_type is not None]
     )
     app.jinja_env.filters["delaytime"] = format_delaytime
+    app.jinja_env.filters["duration"] = format_duration
+
+    @app.cli.command("kiwi-replay")
+    @click.argument("spool", required=False)
+    def kiwi_replay(spool: Optional[str]) -> None:
+        """
+        Upload results left in the Kiwi spool (KIWI_SPOOL by default) to Kiwi.
+        """
+        uploaded, remaining = asyncio.run(
+            kiwi.replay(spool or app.config["KIWI_SPOOL"], app.config["KIWI_VERBOSE"])
+        )
+        print(f"Uploaded {uploaded} results to Kiwi, {remaining} left in the spool")
 
     @app.before_serving
     async def startup() -> None:
+        app.config["artifacts"].reset()
         app.add_background_task(loop_cleanup_unresponsive_adapters)
         app.add_background_task(loop_check_for_new_tests)
         app.add_background_task(loop_check_all_tests_done)
@@ -121,31 +182,31 @@ def create_app(test_config: Optional[Dict[str, Any]] = None) -> Quart:
     @app.after_serving
     async def shutdown() -> None:
         adapter.stop_background_tasks = True
+        events.close()
         await adapter.interrupt_tasks()
+        # Fail whatever is still running first, so its results are reported to Kiwi too.
+        await adapter_shutdown()
         if kiwi.kiwi_client:
             await kiwi.kiwi_client.end_run()
-        await adapter_shutdown()
+        await app.config["homerunner"].close()
+        if app.config["JUNIT_OUTPUT"]:
+            junit.write_junit(app.config["JUNIT_OUTPUT"])
+            print(f"Wrote JUnit results to {app.config['JUNIT_OUTPUT']}")
 
         print("Results:\n")
-        exit_code = 0
-        total_tests = 0
-        successful_tests = 0
         for testsuite in get_testsuites():
             print(
                 f"\n{testsuite.name()}: {testsuite.successes()}/{len(testsuite.test_cases)} successful"
             )
             for testcase in testsuite.test_cases:
                 print(f"  {testcase.client_types}: {testcase.state}")
-                total_tests += 1
-                if testcase.state != "success":
-                    exit_code = 1
-                else:
-                    successful_tests = successful_tests + 1
                 if testcase.state != "success" and testcase.state != "waiting":
                     for exception in testcase.exceptions:
                         print(exception)
 
-        print(f"\nOverall: {successful_tests}/{total_tests} succeeded")
-        os._exit(exit_code)
+        state_counts = get_state_counts()
+        successful_tests = state_counts.count("success")
+        print(f"\nOverall: {successful_tests}/{state_counts.total} succeeded")
+        os._exit(0 if successful_tests == state_counts.total else 1)
 
     return app
@@ -0,0 +1,160 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Storage for files uploaded by adapters, eg videos, logs and snapshots.
+
+Files are stored by the SHA-256 of their content, so a file uploaded many times (eg the same
+snapshot on every get_call_data) is only stored once. The store only holds files from the
+current run; once it holds more than its limit, the files stored (or uploaded again) longest
+ago are deleted, except those still in use by test cases that have not finished.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import IO, Callable, Optional, Set, Tuple
+
+import trafficlight.metrics as metrics
+
+logger = logging.getLogger(__name__)
+
+# Uploads are copied (and hashed) in pieces of this many bytes.
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+@dataclass(frozen=True)
+class Artifact:
+    # SHA-256 of the content, in hex.
+    digest: str
+    size: int
+    # Where the content is stored; it may have been deleted if the store has since filled up.
+    path: str
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+
+class ArtifactStore(object):
+    def __init__(
+        self,
+        root: str,
+        max_bytes: int = 0,
+        in_use: Callable[[], Set[str]] = set,
+    ) -> None:
+        """
+        @param root: directory to store files in; created if needed. Files from earlier runs are
+            left alone until reset() is called.
+        @param max_bytes: most bytes of files to keep for this run, or 0 for no limit.
+        @param in_use: returns the digests of files that must not be deleted to stay under the limit.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self._in_use = in_use
+        self._objects_dir = os.path.join(root, "objects")
+        self._partial_dir = os.path.join(root, "partial")
+        # Size of each stored file, by digest, stored (or uploaded again) longest ago first.
+        self._objects: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        os.makedirs(self._partial_dir, exist_ok=True)
+        os.makedirs(self._objects_dir, exist_ok=True)
+
+    def reset(self) -> None:
+        """
+        Delete every stored file, eg those of an earlier run, so the limit only has to cover this run.
+
+        Only call this when starting a run; anything else using the same root (eg a CLI command)
+        must leave the files of the last run alone.
+        """
+        # Nothing links to files from earlier runs (including any being written when one stopped).
+        shutil.rmtree(self._partial_dir, ignore_errors=True)
+        shutil.rmtree(self._objects_dir, ignore_errors=True)
+        os.makedirs(self._partial_dir)
+        os.makedirs(self._objects_dir)
+        self._objects.clear()
+        self.size = 0
+        self._size_changed()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self._objects_dir, digest[:2], digest)
+
+    async def add(self, source: IO[bytes]) -> Artifact:
+        """
+        Store the content of a file, reading it in pieces.
+
+        @param source: the file, read from its current position to the end.
+        """
+        digest, size, partial_path = await asyncio.get_running_loop().run_in_executor(
+            None, self._write_partial, source
+        )
+        return self._store(digest, size, partial_path)
+
+    def _write_partial(self, source: IO[bytes]) -> Tuple[str, int, str]:
+        # Runs in an executor thread, so it must not touch the store's bookkeeping.
+        sha256 = hashlib.sha256()
+        size = 0
+        with tempfile.NamedTemporaryFile(
+            dir=self._partial_dir, delete=False
+        ) as partial:
+            while chunk := source.read(COPY_CHUNK_SIZE):
+                sha256.update(chunk)
+                partial.write(chunk)
+                size += len(chunk)
+        return sha256.hexdigest(), size, partial.name
+
+    def _store(self, digest: str, size: int, partial_path: str) -> Artifact:
+        path = self.path(digest)
+        if digest in self._objects:
+            os.remove(partial_path)
+            self._objects.move_to_end(digest)
+            metrics.artifact_uploads.labels("duplicate").inc()
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(partial_path, path)
+            self._objects[digest] = size
+            self.size += size
+            metrics.artifact_uploads.labels("stored").inc()
+            self._evict(keep=digest)
+            self._size_changed()
+        return Artifact(digest, size, path)
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        # Always keep the newest file, even if it alone is over the limit.
+        if not self.max_bytes or self.size <= self.max_bytes:
+            return
+        in_use = self._in_use()
+        for digest in list(self._objects.keys()):
+            if self.size <= self.max_bytes:
+                return
+            if digest == keep or digest in in_use:
+                continue
+            size = self._objects.pop(digest)
+            self.size -= size
+            logger.info("Deleting %s (%d bytes) to stay under the limit", digest, size)
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+        logger.warning(
+            "Keeping %d bytes of files, over the limit of %d, as they are still in use",
+            self.size,
+            self.max_bytes,
+        )
+
+    def _size_changed(self) -> None:
+        metrics.artifact_store_bytes.labels().set(self.size)
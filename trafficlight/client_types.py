@@ -2,46 +2,42 @@ from trafficlight.internals.adapter import Adapter
 
 
 class ClientType(object):
+    # The registration "type" of adapters that can run this client type.
+    adapter_type: str
+
     def name(self) -> str:
         return type(self).__name__
 
     def match(self, x: Adapter) -> bool:
-        pass
+        return str(x.registration["type"]) == self.adapter_type
 
     def __repr__(self) -> str:
         return self.name()
 
 
 class ElementWebStable(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "element-web"
+    adapter_type = "element-web"
 
 
 class ElementWebDevelop(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "element-web"
+    adapter_type = "element-web"
 
 
 class HydrogenWeb(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "hydrogen-web"
+    adapter_type = "hydrogen-web"
 
 
 class ElementAndroid(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "element-android"
+    adapter_type = "element-android"
 
 
 class ElementIos(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "element-ios"
+    adapter_type = "element-ios"
 
 
 class ElementCall(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "element-call"
+    adapter_type = "element-call"
 
 
 class NetworkProxy(ClientType):
-    def match(self, x: Adapter) -> bool:
-        return str(x.registration["type"]) == "network-proxy"
+    adapter_type = "network-proxy"
@@ -0,0 +1,124 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Changes to test cases and adapters, published for status pages to follow as they happen.
+
+Events are numbered in the order they are published. The most recent EVENT_HISTORY events
+are kept, so a page can follow on from the event it was rendered at, and a dropped
+connection can pick up where it left off.
+"""
+import asyncio
+import itertools
+import json
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional
+
+EVENT_HISTORY = 1000
+
+
+@dataclass
+class Event:
+    id: int
+    kind: str
+    data: Dict[str, Any]
+
+    def to_sse(self) -> str:
+        return f"id: {self.id}\nevent: {self.kind}\ndata: {json.dumps(self.data)}\n\n"
+
+
+_history: Deque[Event] = deque(maxlen=EVENT_HISTORY)
+_last_id = 0
+# Counts changes of state only, unlike event ids, which also count eg actions and uploads.
+_state_version = 0
+# Set (and replaced) whenever an event is published, or when closing.
+_published = asyncio.Event()
+_closed = False
+
+
+def publish(kind: str, **data: Any) -> None:
+    """
+    Tell anything following events about a change; cheap enough to call on every change.
+
+    @param kind: what changed, eg "test_case" or "adapter".
+    @param data: the change, as JSON-serialisable values.
+    """
+    global _last_id, _published
+    _last_id += 1
+    _history.append(Event(_last_id, kind, data))
+    _published.set()
+    _published = asyncio.Event()
+
+
+def last_id() -> int:
+    return _last_id
+
+
+def state_changed() -> None:
+    """
+    Note that a test case or adapter changed state, eg so status pages are rendered again.
+    """
+    global _state_version
+    _state_version += 1
+
+
+def state_version() -> int:
+    return _state_version
+
+
+def since(event_id: int) -> Optional[List[Event]]:
+    """
+    The events published after event_id, oldest first.
+
+    @return: None if some of those events are no longer kept, or event_id was never published
+        (eg it came from before a restart); the follower must start again from the current state.
+    """
+    if event_id > _last_id:
+        return None
+    if event_id == _last_id:
+        return []
+    oldest = _history[0].id
+    if event_id < oldest - 1:
+        return None
+    return list(itertools.islice(_history, event_id - oldest + 1, None))
+
+
+async def wait(event_id: int, timeout: float) -> bool:
+    """
+    Wait until an event after event_id is published, or until close() is called.
+
+    @return: False if timeout seconds passed first.
+    """
+    published = _published
+    if _last_id > event_id or _closed:
+        return True
+    try:
+        await asyncio.wait_for(published.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+def close() -> None:
+    """
+    Stop everything following events, eg when shutting down.
+    """
+    global _closed
+    _closed = True
+    _published.set()
+
+
+def closed() -> bool:
+    return _closed
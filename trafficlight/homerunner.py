@@ -12,15 +12,36 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 import logging
-from typing import Any, Dict, List
+from datetime import datetime, timedelta
+from typing import Any, Coroutine, Dict, List, Optional, Set
 
 import aiohttp
 
+import trafficlight.metrics as metrics
+import trafficlight.scheduler as scheduler
 from trafficlight.server_types import ServerType
 
 logger = logging.getLogger(__name__)
 
+# Most concurrent connections to homerunner; creating deployments is slow, so this
+# bounds how much work we ask of the Docker host at once.
+HOMERUNNER_CONNECTION_LIMIT = 10
+
+# How long the result of a health check on a static server set is trusted for.
+STATIC_SERVER_HEALTH_CHECK_INTERVAL = timedelta(seconds=30)
+STATIC_SERVER_HEALTH_CHECK_TIMEOUT = aiohttp.ClientTimeout(total=5)
+
+# Before a test starts, each homeserver is probed until it answers /_matrix/client/versions,
+# waiting READY_PROBE_INITIAL_DELAY after the first failure and doubling up to READY_PROBE_MAX_DELAY.
+READY_PROBE_INITIAL_DELAY = 0.1
+READY_PROBE_MAX_DELAY = 2.0
+READY_PROBE_REQUEST_TIMEOUT = 5.0
+READY_TIMEOUT = timedelta(seconds=60)
+# Most concurrent probes to any one homeserver.
+PROBE_CONNECTION_LIMIT = 4
+
 
 class HomerunnerError(Exception):
     def __init__(self, message: str):
@@ -32,21 +53,102 @@ class HomeServer(object):
     The configuration of a created homserver
     """
 
-    def __init__(self, server_name: str, cs_api: str):
+    def __init__(
+        self,
+        server_name: str,
+        cs_api: str,
+        blueprint_name: Optional[str] = None,
+        static_set: Optional["StaticServerSet"] = None,
+    ):
         self.cs_api = cs_api
         self.server_name = server_name
-        # TODO: include sufficient data to destroy
-        # Might not be needed: homerunner does have a timeout
+        # The homerunner deployment this server belongs to, if homerunner created it.
+        self.blueprint_name = blueprint_name
+        # The static server set this server was leased from, if it was configured in SERVER_OVERRIDES.
+        self.static_set = static_set
+
+
+class StaticServerSet(object):
+    """
+    A set of pre-provisioned homeservers from SERVER_OVERRIDES that can stand in for one server type.
+    """
+
+    def __init__(self, servers: List[Dict[str, str]]) -> None:
+        self.servers = servers
+        # How many running test cases are using this set.
+        self.leases = 0
+        self.healthy = True
+        self.last_checked: Optional[datetime] = None
+
+    def __repr__(self) -> str:
+        return f"{[server['cs_api'] for server in self.servers]}"
+
+    def homeservers(self) -> List[HomeServer]:
+        return [
+            HomeServer(
+                server_name=server["server_name"],
+                cs_api=server["cs_api"],
+                static_set=self,
+            )
+            for server in self.servers
+        ]
+
 
-    def finished(self) -> None:
-        pass
+class WarmDeployment(object):
+    """
+    A deployment created ahead of time, waiting to be handed to a test case.
+    """
+
+    def __init__(self, homeservers: List[HomeServer]) -> None:
+        self.homeservers = homeservers
+        self.created = datetime.now()
 
 
 class HomerunnerClient(object):
-    def __init__(self, homerunner_url: str, server_overrides: Dict[str, Any]) -> None:
+    def __init__(
+        self,
+        homerunner_url: str,
+        server_overrides: Dict[str, Any],
+        pool_sizes: Optional[Dict[str, int]] = None,
+        pool_max_age: timedelta = timedelta(minutes=20),
+        capacity: int = 0,
+        check_server_overrides: bool = False,
+    ) -> None:
         self.homerunner_url = homerunner_url
         self.hsid = 0
-        self.server_overrides = server_overrides
+        self.pool_id = 0
+        # Each overridden server type maps to one or more equivalent sets of static servers;
+        # test cases lease the least used set.
+        self.server_overrides: Dict[str, List[StaticServerSet]] = {
+            name: _parse_override(override)
+            for name, override in server_overrides.items()
+        }
+        # Whether to skip static server sets that don't answer /_matrix/client/versions.
+        self.check_server_overrides = check_server_overrides
+        # How many deployments of each server type (by name) to keep ready in advance.
+        self.pool_sizes = pool_sizes or {}
+        # Homerunner expires deployments itself (after 30 minutes by default), so don't
+        # hand out anything that has been waiting for too long.
+        self.pool_max_age = pool_max_age
+        self._pool: Dict[str, List[WarmDeployment]] = {}
+        self._warming: Dict[str, int] = {}
+        self._background_tasks: Set[asyncio.Task[None]] = set()
+        # The most homeservers to run at once (0 for no limit). Each deployment holds
+        # capacity from when it is requested until homerunner has torn it down.
+        self.capacity = capacity
+        self.capacity_used = 0
+        self._deployment_weights: Dict[str, int] = {}
+        # Capacity that will be freed once deployments being torn down are gone.
+        self._releasing = 0
+        # Test cases admitted by reserve() but not yet created, and whether each one
+        # claimed a ready deployment from the pool rather than new capacity.
+        self._reservations: Dict[str, bool] = {}
+        self._claimed: Dict[str, int] = {}
+        # One connection pool for every homerunner request, created on first use.
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Homeservers are probed over their own connection pool, so probes never queue
+        # behind slow /create requests for the homerunner connection limit.
+        self._probe_session: Optional[aiohttp.ClientSession] = None
 
     def _generate_homeserver(self, base_image_uri: str) -> Dict[str, Any]:
         """
@@ -64,17 +166,353 @@ class HomerunnerClient(object):
         self, test_case_id: str, server_type: ServerType
     ) -> List[HomeServer]:
         if server_type.name() in self.server_overrides:
-            override = self.server_overrides[server_type.name()]
-            homeserver_configs = []
-            for item in override:
-                homeserver_configs.append(
-                    HomeServer(server_name=item["server_name"], cs_api=item["cs_api"])
+            static_set = await self._lease_static_set(server_type)
+            logger.info("Using static servers %s for %s", static_set, test_case_id)
+            return static_set.homeservers()
+
+        name = server_type.name()
+        claimed_from_pool = self._reservations.pop(test_case_id, None)
+        if claimed_from_pool:
+            self._claimed[name] -= 1
+        if claimed_from_pool or (
+            claimed_from_pool is None and self._unclaimed_ready(name) > 0
+        ):
+            warm_deployment = self._take_from_pool(server_type)
+            if warm_deployment is not None:
+                logger.info(
+                    "Using pre-created %s deployment for %s", server_type, test_case_id
                 )
-            return homeserver_configs
-        else:
-            return await self._create_complement(
+                return warm_deployment.homeservers
+
+        weight = self.weight(server_type)
+        if claimed_from_pool is not False:
+            # Not admitted with new capacity (or the claimed deployment expired), so take it now,
+            # even if that goes over budget; the test case has already started.
+            self.capacity_used += weight
+        try:
+            homeservers = await self._create_complement(
                 test_case_id, server_type.complement_types()
             )
+        except Exception:
+            self._free_capacity(weight)
+            raise
+        self._deployment_weights[test_case_id] = weight
+        scheduler.notify("homeserver ready")
+        return homeservers
+
+    async def wait_until_ready(self, homeservers: List[HomeServer]) -> Dict[str, float]:
+        """
+        Wait until every homeserver answers /_matrix/client/versions, probing them all at once.
+
+        @return: how long each homeserver took to answer, in seconds, by server name.
+        @raise HomerunnerError: if any homeserver is not ready within READY_TIMEOUT.
+        """
+        deadline = asyncio.get_running_loop().time() + READY_TIMEOUT.total_seconds()
+        ready_times = await asyncio.gather(
+            *[self._probe(homeserver, deadline) for homeserver in homeservers]
+        )
+        return {
+            homeserver.server_name: ready_time
+            for homeserver, ready_time in zip(homeservers, ready_times)
+        }
+
+    async def _probe(self, homeserver: HomeServer, deadline: float) -> float:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        versions_url = _versions_url(homeserver.cs_api)
+        delay = READY_PROBE_INITIAL_DELAY
+        attempts = 0
+        while True:
+            attempts += 1
+            remaining = deadline - loop.time()
+            try:
+                async with self._get_probe_session().get(
+                    versions_url,
+                    timeout=aiohttp.ClientTimeout(
+                        total=max(0.0, min(READY_PROBE_REQUEST_TIMEOUT, remaining))
+                    ),
+                ) as rsp:
+                    if rsp.status == 200:
+                        ready_time = loop.time() - started
+                        metrics.homeserver_ready_seconds.labels().observe(ready_time)
+                        return ready_time
+                    last_error = f"HTTP {rsp.status}"
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = str(e) or type(e).__name__
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise HomerunnerError(
+                    f"Homeserver {homeserver.server_name} ({homeserver.cs_api}) was not ready after"
+                    f" {loop.time() - started:.1f}s and {attempts} attempts: {last_error}"
+                )
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, READY_PROBE_MAX_DELAY)
+
+    def weight(self, server_type: ServerType) -> int:
+        """
+        How much capacity a deployment of server_type uses: one per homeserver image.
+
+        Overridden server types are not created by homerunner, so use none.
+        """
+        if server_type.name() in self.server_overrides:
+            return 0
+        return len(server_type.complement_types())
+
+    def check_capacity(self, server_types: List[ServerType]) -> None:
+        """
+        Make sure a deployment of each server type fits in the capacity at all.
+
+        @raise HomerunnerError: if one never could, as its test cases would wait forever.
+        """
+        if self.capacity <= 0:
+            return
+        for server_type in server_types:
+            if self.weight(server_type) > self.capacity:
+                raise HomerunnerError(
+                    f"HOMESERVER_CAPACITY is {self.capacity}, but {server_type.name()}"
+                    f" needs {self.weight(server_type)} homeservers"
+                )
+
+    def can_admit(self, server_type: ServerType) -> bool:
+        """
+        Whether a test case using server_type could be given homeservers without going over capacity.
+        """
+        weight = self.weight(server_type)
+        return (
+            weight == 0
+            or self._unclaimed_ready(server_type.name()) > 0
+            or self._has_room(weight)
+        )
+
+    def reserve(self, test_case_id: str, server_type: ServerType) -> None:
+        """
+        Set aside homeservers for a test case that is about to start, when can_admit() allows it.
+
+        A ready deployment from the pool is claimed if there is one, otherwise capacity
+        for a new deployment is taken. The reservation is used by the next create() for test_case_id.
+        """
+        weight = self.weight(server_type)
+        if weight == 0:
+            return
+        name = server_type.name()
+        if self._unclaimed_ready(name) > 0:
+            self._claimed[name] = self._claimed.get(name, 0) + 1
+            self._reservations[test_case_id] = True
+        else:
+            self.capacity_used += weight
+            self._reservations[test_case_id] = False
+
+    def capacity_status(self) -> Dict[str, int]:
+        return {"used": self.capacity_used, "capacity": self.capacity}
+
+    def _has_room(self, weight: int) -> bool:
+        return self.capacity <= 0 or self.capacity_used + weight <= self.capacity
+
+    def _unclaimed_ready(self, name: str) -> int:
+        return len(self._pool.get(name, [])) - self._claimed.get(name, 0)
+
+    def _free_capacity(self, weight: int) -> None:
+        if weight > 0:
+            self.capacity_used -= weight
+            scheduler.notify("homeserver capacity freed")
+
+    def fill_pool(self, waiting_server_types: List[ServerType]) -> None:
+        """
+        Start creating deployments in the background for server types that waiting test cases need.
+
+        For each server type, enough deployments are started to cover the waiting test cases,
+        up to the configured pool size for that type, counting those already ready or being created.
+        Deployments are only started while there is spare capacity.
+        @param waiting_server_types: the server type of each waiting test case.
+        """
+        demand: Dict[str, int] = {}
+        server_types: Dict[str, ServerType] = {}
+        for server_type in waiting_server_types:
+            name = server_type.name()
+            if self.pool_sizes.get(name, 0) <= 0 or name in self.server_overrides:
+                continue
+            demand[name] = demand.get(name, 0) + 1
+            server_types[name] = server_type
+
+        for name, waiting in demand.items():
+            self._discard_expired(name)
+            wanted = min(waiting, self.pool_sizes[name])
+            have = max(self._unclaimed_ready(name), 0) + self._warming.get(name, 0)
+            weight = self.weight(server_types[name])
+            for _ in range(wanted - have):
+                if not self._has_room(weight):
+                    # A lighter server type may still fit.
+                    break
+                self.capacity_used += weight
+                self._warming[name] = self._warming.get(name, 0) + 1
+                self._run_in_background(self._warm(server_types[name]))
+
+    def reclaim_capacity(self, server_type: ServerType) -> None:
+        """
+        Tear down ready deployments that no test case has claimed, until there will be room for server_type.
+
+        Warm deployments are only a head start, so they give way to a test case that could
+        otherwise start now. Teardown runs in the background; the capacity is free once it is done.
+        """
+        if self.capacity <= 0:
+            return
+        needed = (
+            self.capacity_used
+            - self._releasing
+            + self.weight(server_type)
+            - self.capacity
+        )
+        for name, pool in self._pool.items():
+            while needed > 0 and self._unclaimed_ready(name) > 0:
+                warm_deployment = pool.pop()
+                logger.info("Tearing down unused %s deployment to make room", name)
+                needed -= sum(
+                    self._deployment_weights.get(blueprint_name, 0)
+                    for blueprint_name in _blueprint_names(warm_deployment.homeservers)
+                )
+                self.release(warm_deployment.homeservers)
+
+    def pool_status(self) -> Dict[str, Dict[str, int]]:
+        return {
+            name: {
+                "ready": len(self._pool.get(name, [])),
+                "warming": self._warming.get(name, 0),
+                "size": size,
+            }
+            for name, size in self.pool_sizes.items()
+        }
+
+    async def _warm(self, server_type: ServerType) -> None:
+        name = server_type.name()
+        weight = self.weight(server_type)
+        try:
+            self.pool_id = self.pool_id + 1
+            blueprint_name = f"trafficlight-pool-{name}-{self.pool_id}"
+            homeservers = await self._create_complement(
+                blueprint_name,
+                server_type.complement_types(),
+            )
+            self._deployment_weights[blueprint_name] = weight
+            self._pool.setdefault(name, []).append(WarmDeployment(homeservers))
+            logger.info("Pre-created %s deployment is ready", server_type)
+            scheduler.notify("homeserver ready")
+        except Exception:
+            logger.exception("Unable to pre-create %s deployment", server_type)
+            self._free_capacity(weight)
+        finally:
+            self._warming[name] -= 1
+
+    def release(self, homeservers: List[HomeServer]) -> None:
+        """
+        Tear down the deployments behind the given homeservers once a test case is done with them.
+
+        Teardown runs in the background, so the next test case can start while it happens.
+        Static servers are handed back to their set instead.
+        """
+        static_sets = {
+            homeserver.static_set
+            for homeserver in homeservers
+            if homeserver.static_set is not None
+        }
+        for static_set in static_sets:
+            static_set.leases -= 1
+        for blueprint_name in _blueprint_names(homeservers):
+            self._releasing += self._deployment_weights.get(blueprint_name, 0)
+            self._run_in_background(self._destroy_complement(blueprint_name))
+
+    async def close(self) -> None:
+        """
+        Tear down any pre-created deployments and wait for pending teardowns, then close connections.
+        """
+        for name in list(self._pool.keys()):
+            for warm_deployment in self._pool.pop(name):
+                self.release(warm_deployment.homeservers)
+        if self._background_tasks:
+            await asyncio.wait(self._background_tasks)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._probe_session is not None:
+            await self._probe_session.close()
+            self._probe_session = None
+
+    async def _lease_static_set(self, server_type: ServerType) -> StaticServerSet:
+        static_sets = self.server_overrides[server_type.name()]
+        if self.check_server_overrides:
+            now = datetime.now()
+            await asyncio.gather(
+                *[
+                    self._check_static_set(static_set)
+                    for static_set in static_sets
+                    if static_set.last_checked is None
+                    or now - static_set.last_checked
+                    >= STATIC_SERVER_HEALTH_CHECK_INTERVAL
+                ]
+            )
+        healthy = [static_set for static_set in static_sets if static_set.healthy]
+        if not healthy:
+            raise HomerunnerError(f"No healthy static servers for {server_type}")
+        # min() picks the first of equally used sets, so ties go to the earliest configured.
+        static_set = min(healthy, key=lambda candidate: candidate.leases)
+        static_set.leases += 1
+        return static_set
+
+    async def _check_static_set(self, static_set: StaticServerSet) -> None:
+        healthy = True
+        for server in static_set.servers:
+            versions_url = _versions_url(server["cs_api"])
+            try:
+                async with self._get_probe_session().get(
+                    versions_url, timeout=STATIC_SERVER_HEALTH_CHECK_TIMEOUT
+                ) as rsp:
+                    if rsp.status != 200:
+                        raise HomerunnerError(await rsp.text())
+            except Exception as e:
+                logger.warning("Static server %s is unhealthy: %s", versions_url, e)
+                healthy = False
+                break
+        static_set.healthy = healthy
+        static_set.last_checked = datetime.now()
+
+    def _run_in_background(self, coroutine: Coroutine[Any, Any, None]) -> None:
+        task = asyncio.create_task(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=HOMERUNNER_CONNECTION_LIMIT)
+            )
+        return self._session
+
+    def _get_probe_session(self) -> aiohttp.ClientSession:
+        if self._probe_session is None:
+            self._probe_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=PROBE_CONNECTION_LIMIT)
+            )
+        return self._probe_session
+
+    def _take_from_pool(self, server_type: ServerType) -> Optional[WarmDeployment]:
+        name = server_type.name()
+        self._discard_expired(name)
+        pool = self._pool.get(name)
+        if pool:
+            return pool.pop(0)
+        return None
+
+    def _discard_expired(self, name: str) -> None:
+        now = datetime.now()
+        pool = self._pool.get(name, [])
+        fresh = [d for d in pool if now - d.created < self.pool_max_age]
+        if len(fresh) < len(pool):
+            logger.info(
+                "Discarding %s expired %s deployments", len(pool) - len(fresh), name
+            )
+            self._pool[name] = fresh
+            for warm_deployment in pool:
+                if warm_deployment not in fresh:
+                    self.release(warm_deployment.homeservers)
 
     async def _create_complement(
         self, test_case_id: str, images: List[str]
@@ -91,21 +529,61 @@ class HomerunnerClient(object):
             "blueprint": {"Name": test_case_id, "Homeservers": homeservers},
         }
         logger.info(data)
-        async with aiohttp.ClientSession() as session:
-            async with session.post(create_url, json=data) as rsp:
+        started = asyncio.get_running_loop().time()
+        async with self._get_session().post(create_url, json=data) as rsp:
+            if rsp.status != 200:
+                error = await rsp.text()
+                raise HomerunnerError(error)
+
+            json = await rsp.json()
+
+            response = json["homeservers"]
+
+            homeserver_configs = []
+            for homeserver in homeservers:
+                # from our request
+                name = homeserver["Name"]
+                # from response
+                cs_api = response[name]["BaseURL"]
+                homeserver_configs.append(HomeServer(name, cs_api, test_case_id))
+            metrics.homerunner_create_seconds.labels().observe(
+                asyncio.get_running_loop().time() - started
+            )
+            return homeserver_configs
+
+    async def _destroy_complement(self, blueprint_name: str) -> None:
+        destroy_url = self.homerunner_url + "/destroy"
+        try:
+            async with self._get_session().post(
+                destroy_url, json={"blueprint_name": blueprint_name}
+            ) as rsp:
                 if rsp.status != 200:
                     error = await rsp.text()
                     raise HomerunnerError(error)
+            logger.info("Destroyed deployment %s", blueprint_name)
+        except Exception:
+            # Not fatal; homerunner will expire the deployment eventually.
+            logger.exception("Unable to destroy deployment %s", blueprint_name)
+        finally:
+            weight = self._deployment_weights.pop(blueprint_name, 0)
+            self._releasing -= weight
+            self._free_capacity(weight)
+
+
+def _blueprint_names(homeservers: List[HomeServer]) -> Set[str]:
+    return {
+        homeserver.blueprint_name
+        for homeserver in homeservers
+        if homeserver.blueprint_name is not None
+    }
+
 
-                json = await rsp.json()
+def _versions_url(cs_api: str) -> str:
+    return cs_api.rstrip("/") + "/_matrix/client/versions"
 
-                response = json["homeservers"]
 
-                homeserver_configs = []
-                for homeserver in homeservers:
-                    # from our request
-                    name = homeserver["Name"]
-                    # from response
-                    cs_api = response[name]["BaseURL"]
-                    homeserver_configs.append(HomeServer(name, cs_api))
-                return homeserver_configs
+def _parse_override(override: List[Any]) -> List[StaticServerSet]:
+    # Either a single list of servers, or a list of equivalent lists of servers.
+    if override and isinstance(override[0], list):
+        return [StaticServerSet(servers) for servers in override]
+    return [StaticServerSet(override)]
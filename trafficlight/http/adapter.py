@@ -14,12 +14,15 @@
 # limitations under the License.
 import asyncio
 import logging
+import time
 from datetime import datetime, timedelta
-from typing import Any, Dict, Set, cast
+from typing import Any, Dict, Optional, Set, cast
 
-from quart import Blueprint, current_app, request
+from quart import Blueprint, Response, current_app, g, request, websocket
 from werkzeug.utils import secure_filename
 
+import trafficlight.metrics as metrics
+import trafficlight.scheduler as scheduler
 from trafficlight.internals.adapter import Adapter
 from trafficlight.internals.exceptions import (
     ActionException,
@@ -32,13 +35,17 @@ from trafficlight.store import (
     add_adapter,
     get_adapter,
     get_adapters,
+    get_available_adapters,
+    get_state_counts,
     get_tests,
-    get_testsuites,
     remove_adapter,
 )
 
 IDLE_ADAPTER_UNRESPONSIVE_DELAY = timedelta(minutes=1)
 ACTIVE_ADAPTER_UNRESPONSIVE_DELAY = timedelta(minutes=3)
+# Longest time a long-polling request may be held open; must stay well under the
+# unresponsive delays above so waiting adapters are never timed out.
+LONG_POLL_MAX_TIMEOUT = timedelta(seconds=30)
 # Set transitions' log level to INFO; DEBUG messages will be omitted
 
 
@@ -48,28 +55,62 @@ logger = logging.getLogger(__name__)
 bp = Blueprint("client", __name__, url_prefix="/client")
 
 
-async def check_for_new_tests() -> None:
-    test_cases = get_tests()
-    available_adapters = list(filter(lambda x: x.available(), get_adapters()))
-    for test_case in test_cases:
-        if test_case.state == "waiting":
-            adapters_required = test_case.allocate_adapters(available_adapters)
-            if adapters_required is not None:
-                logger.info("Starting test %s", test_case)
+@bp.before_request
+async def start_request_timer() -> None:
+    g.request_started = time.monotonic()
 
-                homerunner = current_app.config["homerunner"]
 
-                async def run() -> None:
-                    await test_case.run(adapters_required, homerunner)
-
-                current_app.add_background_task(run)
-                return
+@bp.after_request
+async def record_request_time(response: Response) -> Response:
+    metrics.http_request_seconds.labels(str(request.endpoint)).observe(
+        time.monotonic() - g.request_started
+    )
+    return response
+
+
+async def check_for_new_tests() -> scheduler.SchedulingPass:
+    available_adapters = get_available_adapters()
+    homerunner = current_app.config["homerunner"]
+    scheduling_pass = scheduler.plan(get_tests(), available_adapters, homerunner)
+
+    # Claim the adapters for every test case before starting any of them, so a pass
+    # triggered before the tests start running cannot allocate them again.
+    for test_case, adapters in scheduling_pass.allocations:
+        logger.info("Starting test %s", test_case)
+        test_case.prepare(adapters)
+
+    for test_case, _ in scheduling_pass.allocations:
+        current_app.add_background_task(test_case.run, homerunner)
+
+    for reason in (
+        scheduler.NO_FREE_ADAPTER,
+        scheduler.ADAPTERS_ALLOCATED,
+        scheduler.NO_HOMESERVER_CAPACITY,
+    ):
+        metrics.waiting_test_cases.labels(reason).set(
+            scheduling_pass.unplaced_reasons.get(reason, 0)
+        )
 
-    logger.debug(
-        "Not enough client_types to run any test(have %s)",
-        [str(item) for item in available_adapters],
+    # Get homeservers ready for the test cases that are still waiting, so they can start
+    # as soon as adapters are free.
+    homerunner.fill_pool(
+        [
+            test_case.server_type
+            for test_case in scheduling_pass.unplaced.keys()
+            if test_case.server_type is not None
+        ]
     )
 
+    if scheduling_pass.allocations:
+        logger.info("Scheduling pass %s", scheduling_pass.summary())
+    else:
+        logger.debug(
+            "Not enough client_types to run any test(have %s): %s",
+            available_adapters,
+            scheduling_pass.summary(),
+        )
+    return scheduling_pass
+
 
 last_cleanup = datetime.now()
 stop_background_tasks = False
@@ -124,21 +165,24 @@ async def interrupt_tasks() -> None:
     logger.info("Waking up background tasks")
     for task in sleeping_tasks:
         task.cancel()
+    scheduler.notify("interrupted")
 
 
 def should_finish_tests() -> bool:
-    for testsuite in get_testsuites():
-        for testcase in testsuite.test_cases:
-            if testcase.state not in ("failed", "error", "success"):
-                logger.info(f"Not exiting because of {testcase}")
-                return False
+    state_counts = get_state_counts()
+    unfinished = state_counts.total - state_counts.count("failed", "error", "success")
+    if unfinished > 0:
+        logger.info(f"Not exiting because {unfinished} test cases are unfinished")
+        return False
     return True
 
 
 async def loop_check_all_tests_done() -> None:
     while not stop_background_tasks:
         logging.debug("Running check for test completion")
-        if should_finish_tests():
+        with metrics.background_loop_seconds.labels("check_all_tests_done").time():
+            finished = should_finish_tests()
+        if finished:
             # do not await because shutdown() awaits all background tasks (inc this one) to shut down first.
             asyncio.create_task(current_app.shutdown())
 
@@ -156,7 +200,10 @@ async def loop_check_all_tests_done() -> None:
 async def loop_cleanup_unresponsive_adapters() -> None:
     while not stop_background_tasks:
         logging.debug("Running sweep for idle adapters")
-        await cleanup_unresponsive_adapters()
+        with metrics.background_loop_seconds.labels(
+            "cleanup_unresponsive_adapters"
+        ).time():
+            await cleanup_unresponsive_adapters()
 
         sleep_task: asyncio.Future[None] = asyncio.ensure_future(asyncio.sleep(30))
         try:
@@ -170,17 +217,14 @@ async def loop_cleanup_unresponsive_adapters() -> None:
 
 
 async def loop_check_for_new_tests() -> None:
+    # Runs a scheduling pass whenever something notifies the scheduler (see trafficlight.scheduler),
+    # with a periodic sweep as a fallback.
     while not stop_background_tasks:
         logging.debug("Running sweep for new tests")
-        await check_for_new_tests()
-        sleep_task: asyncio.Future[None] = asyncio.ensure_future(asyncio.sleep(30))
-        try:
-            sleeping_tasks.add(sleep_task)
-            await sleep_task
-        except asyncio.CancelledError:
-            pass  # we don't mind this task being cancelled.
-        finally:
-            sleeping_tasks.remove(sleep_task)
+        with metrics.background_loop_seconds.labels("check_for_new_tests").time():
+            await check_for_new_tests()
+        reasons = await scheduler.wait_for_events()
+        logging.debug("Scheduler woken by %s", reasons or "fallback sweep")
     logging.info("New test task shutting down")
 
 
@@ -189,9 +233,7 @@ async def adapter_shutdown() -> None:
         adapter.error(ShutdownException("Shutting down trafficlight"))
 
 
-@bp.route("/<string:adapter_uuid>/register", methods=["POST"])
-async def register(adapter_uuid: str):  # type: ignore
-    registration = cast(Dict[str, Any], await request.json)
+def register_adapter(adapter_uuid: str, registration: Dict[str, Any]) -> Adapter:
     logger.info("%s (    ) registered: %s", adapter_uuid, registration)
 
     existing = get_adapter(adapter_uuid)
@@ -202,24 +244,45 @@ async def register(adapter_uuid: str):  # type: ignore
             logger.info(
                 "Adapter re-registered, returning OK again if registration matches"
             )
-            return {}
+            return existing
     adapter = Adapter(adapter_uuid, registration)
     add_adapter(adapter)
-    await interrupt_tasks()
+    scheduler.notify("adapter registered")
+    return adapter
+
+
+@bp.route("/<string:adapter_uuid>/register", methods=["POST"])
+async def register(adapter_uuid: str):  # type: ignore
+    registration = cast(Dict[str, Any], await request.json)
+    register_adapter(adapter_uuid, registration)
     return {}
 
 
+def _batch_size() -> int:
+    # Adapters opt in to receiving queued actions in batches by passing ?batch=<max actions>
+    return max(0, request.args.get("batch", default=0, type=int))
+
+
+def _long_poll_timeout() -> float:
+    # Adapters opt in to long-polling by passing ?timeout=<milliseconds>
+    timeout = timedelta(milliseconds=request.args.get("timeout", default=0, type=int))
+    return min(timeout, LONG_POLL_MAX_TIMEOUT).total_seconds()
+
+
 @bp.route("/<string:uuid>/poll", methods=["GET"])
 async def poll(uuid: str):  # type: ignore
     adapter = get_adapter(uuid)
     poll_response: Dict[str, Any]
+    timeout = _long_poll_timeout()
 
     if adapter is None:
         # Very bad situation; client believes it's registered; server has no record
         # do not update server state; tell client to exit and restart with new UUID.
         poll_response = {"action": "exit", "data": {"reason": "no record of this UUID"}}
+    elif timeout > 0:
+        poll_response = await adapter.wait_for_action(timeout, _batch_size())
     else:
-        poll_response = adapter.poll()
+        poll_response = adapter.poll(batch=_batch_size())
 
     logger.info(f"Returning {poll_response} to {uuid}")
 
@@ -235,35 +298,26 @@ async def respond(uuid: str):  # type: ignore
 
     files = {}
     for name, file in (await request.files).items():
-        filename = secure_filename(file.filename)
-        target = str(current_app.config.get("UPLOAD_FOLDER")) + uuid + filename
-        logger.info(f"Uploading file {name} to {target}")
-        files[name] = target
-        await file.save(target)
+        artifact = await current_app.config["artifacts"].add(file.stream)
+        logger.info(f"Uploaded file {name} to {artifact.path}")
+        files[name] = artifact.path
 
     response = await request.json
     update = cast(Dict[str, Any], response)
     adapter.respond(update, files)
 
-    return {}
-
+    # Adapters can opt in to receiving their next action in the response with ?timeout=<milliseconds>,
+    # saving a separate poll. As with polling, "idle" is returned if nothing arrives in time.
+    timeout = _long_poll_timeout()
+    if timeout > 0:
+        next_action = await adapter.wait_for_action(timeout, _batch_size())
+        logger.info(f"Returning {next_action} to {uuid}")
+        return next_action
 
-@bp.route("/<string:uuid>/error", methods=["POST"])
-async def error(uuid: str):  # type: ignore
-    adapter = get_adapter(uuid)
-    error_json = await request.json
-    logger.info(error_json)
-    if adapter is None:
-        # Again, bad situation; client is doing something and no-one knows why
-        # But in this case it's trying to complain, so we should express it in the logs
-        logger.info("Got error from ${uuid}, unable to route internally\n${response}")
-        raise Exception("Unknown adapter raising error")
-
-    if error_json is None:
-        raise Exception("Error request did not include a JSON body")
+    return {}
 
-    update = cast(Dict[str, Any], error_json)
 
+def report_adapter_error(adapter: Adapter, update: Dict[str, Any]) -> None:
     # Using the same API format as sentry to capture the error in a reasonable way:
     # {
     #    "error": {
@@ -290,6 +344,23 @@ async def error(uuid: str):  # type: ignore
 
     adapter.error(exception)
 
+
+@bp.route("/<string:uuid>/error", methods=["POST"])
+async def error(uuid: str):  # type: ignore
+    adapter = get_adapter(uuid)
+    error_json = await request.json
+    logger.info(error_json)
+    if adapter is None:
+        # Again, bad situation; client is doing something and no-one knows why
+        # But in this case it's trying to complain, so we should express it in the logs
+        logger.info("Got error from ${uuid}, unable to route internally\n${response}")
+        raise Exception("Unknown adapter raising error")
+
+    if error_json is None:
+        raise Exception("Error request did not include a JSON body")
+
+    report_adapter_error(adapter, cast(Dict[str, Any], error_json))
+
     return {}
 
 
@@ -305,9 +376,83 @@ async def upload(uuid: str):  # type: ignore
 
     for name, file in (await request.files).items():
         filename = secure_filename(file.filename)
-        target = str(current_app.config.get("UPLOAD_FOLDER")) + uuid + filename
-        logger.info(f"Uploading file {name} to {target}")
-        await file.save(target)
-        adapter.upload(filename, target)
+        artifact = await current_app.config["artifacts"].add(file.stream)
+        logger.info(f"Uploaded file {name} ({filename}) to {artifact.path}")
+        adapter.upload(filename, artifact)
 
     return {}
+
+
+async def _push_actions(adapter: Adapter) -> None:
+    # Push each new action to the adapter as soon as the test sets it. Only one action is
+    # outstanding at a time; the next is pushed once the adapter has responded to the last.
+    while True:
+        changed = adapter.change_event()
+        action = adapter.next_push()
+        if action is not None:
+            logger.info(f"Pushing {action} to {adapter.guid}")
+            await websocket.send_json({"type": "action", "data": action})
+            if action["action"] == "exit":
+                return
+            continue
+        try:
+            await asyncio.wait_for(
+                changed.wait(), LONG_POLL_MAX_TIMEOUT.total_seconds()
+            )
+        except asyncio.TimeoutError:
+            # Nothing to do for a while; check the adapter is still there. It only
+            # counts as polling when it answers.
+            await websocket.send_json({"type": "ping"})
+
+
+@bp.websocket("/<string:uuid>/ws")
+async def adapter_websocket(uuid: str) -> None:
+    # Carries the same messages as the HTTP API, as JSON text frames. The adapter sends
+    #   {"type": "register" | "respond" | "error", "data": {...}}
+    # with data as the body of the matching HTTP request, and is sent
+    #   {"type": "action", "data": {...}}
+    # with data as a poll response, as soon as there is something to do.
+    # While idle, the adapter is sent {"type": "ping"} every LONG_POLL_MAX_TIMEOUT and
+    # should answer {"type": "pong"}; every message from the adapter counts as a poll.
+    # Files are still uploaded over HTTP.
+    push_task: Optional[asyncio.Task[None]] = None
+    try:
+        while True:
+            adapter = get_adapter(uuid)
+            if adapter is not None and push_task is None:
+                push_task = asyncio.ensure_future(_push_actions(adapter))
+
+            message = cast(Dict[str, Any], await websocket.receive_json())
+            message_type = message.get("type")
+            data = cast(Dict[str, Any], message.get("data", {}))
+            if adapter is not None:
+                adapter.last_polled = datetime.now()
+            try:
+                if message_type == "register":
+                    register_adapter(uuid, data)
+                elif adapter is None:
+                    # Same as polling: the adapter should exit and restart with a new UUID.
+                    await websocket.send_json(
+                        {
+                            "type": "action",
+                            "data": {
+                                "action": "exit",
+                                "data": {"reason": "no record of this UUID"},
+                            },
+                        }
+                    )
+                elif message_type == "pong":
+                    pass
+                elif message_type == "respond":
+                    adapter.respond(data, {})
+                elif message_type == "error":
+                    logger.info(data)
+                    report_adapter_error(adapter, data)
+                else:
+                    raise Exception(f"Unknown message type {message_type}")
+            except Exception as e:
+                logger.exception("Unable to handle websocket message from %s", uuid)
+                await websocket.send_json({"type": "error", "data": {"reason": str(e)}})
+    finally:
+        if push_task is not None:
+            push_task.cancel()
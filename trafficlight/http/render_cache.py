@@ -0,0 +1,93 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import hashlib
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from quart import Response, make_response, request
+
+import trafficlight.events as events
+import trafficlight.metrics as metrics
+
+# Pages also show things that change without a change of state, eg actions, uploaded files
+# and how long a test case has been running, so a page is rendered again after this long.
+RENDER_CACHE_MAX_AGE_SECONDS = 5.0
+# Most pages to keep, counting each combination of query parameters separately.
+RENDER_CACHE_SIZE = 128
+
+
+@dataclass
+class RenderedPage:
+    # The events.state_version() this page was rendered at.
+    version: int
+    rendered_at: float
+    body: bytes
+    content_type: str
+    etag: str
+
+    def current(self, version: int) -> bool:
+        return (
+            self.version == version
+            and time.monotonic() - self.rendered_at < RENDER_CACHE_MAX_AGE_SECONDS
+        )
+
+
+_pages: "OrderedDict[str, RenderedPage]" = OrderedDict()
+
+
+def cached_render(view: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """
+    Serve a GET view from a cache of rendered pages, with an ETag so unchanged pages get a 304.
+
+    A page is rendered again once a test case or adapter has changed state since it was
+    rendered, or once it is RENDER_CACHE_MAX_AGE_SECONDS old. Only successful responses are cached.
+    """
+
+    @functools.wraps(view)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        key = request.full_path
+        version = events.state_version()
+        page = _pages.get(key)
+        if page is not None and page.current(version):
+            metrics.render_cache.labels("hit").inc()
+            _pages.move_to_end(key)
+        else:
+            metrics.render_cache.labels("miss").inc()
+            response = await make_response(await view(*args, **kwargs))
+            if not isinstance(response, Response) or response.status_code != 200:
+                return response
+            body = await response.get_data(as_text=False)
+            page = RenderedPage(
+                version,
+                time.monotonic(),
+                body,
+                response.content_type or "text/html",
+                hashlib.md5(body).hexdigest(),
+            )
+            _pages[key] = page
+            _pages.move_to_end(key)
+            while len(_pages) > RENDER_CACHE_SIZE:
+                _pages.popitem(last=False)
+
+        cached = Response(page.body, content_type=page.content_type)
+        cached.set_etag(page.etag)
+        # Browsers and CI should check back (cheaply, with If-None-Match) rather than reuse a stale copy.
+        cached.headers["Cache-Control"] = "no-cache"
+        return await cached.make_conditional(request)
+
+    return wrapper
@@ -14,7 +14,11 @@
 # limitations under the License.
 import logging
 
-from quart import Blueprint, redirect, url_for
+from quart import Blueprint, Response, redirect, url_for
+
+import trafficlight.metrics as metrics
+from trafficlight.internals.testcase import TestCaseState
+from trafficlight.store import get_state_counts
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -26,3 +30,13 @@ bp = Blueprint("root", __name__, url_prefix="/")
 @bp.route("/", methods=["GET"])
 async def redirect_status():  # type: ignore
     return redirect(url_for("status.index"))
+
+
+@bp.route("/metrics", methods=["GET"])
+async def prometheus_metrics():  # type: ignore
+    state_counts = get_state_counts()
+    for state in TestCaseState:
+        metrics.test_cases.labels(state).set(state_counts.count(state))
+    return Response(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
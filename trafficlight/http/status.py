@@ -12,85 +12,183 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import asyncio
 import logging
-from typing import List
-
-from quart import Blueprint, abort, render_template, request, send_file
-
-from trafficlight.internals.testsuite import TestSuite
-from trafficlight.store import (
-    get_adapters,
-    get_test_case,
-    get_tests,
-    get_testsuite,
-    get_testsuites,
+import mimetypes
+import time
+import uuid
+from typing import AsyncIterator, List
+
+from quart import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    render_template,
+    request,
+    send_file,
 )
 
+import trafficlight.events as events
+import trafficlight.junit as junit
+import trafficlight.metrics as metrics
+import trafficlight.query as query
+from trafficlight.http.render_cache import cached_render
+from trafficlight.http.status_api import page_args
+from trafficlight.store import get_state_counts, get_test_case, get_testsuite
+
 logger = logging.getLogger(__name__)
 
 bp = Blueprint("status", __name__, url_prefix="/status")
 
+# Send a comment this often on an idle event stream, so proxies don't close it.
+EVENT_STREAM_KEEPALIVE_SECONDS = 15
+# How many of each kind of adapter the index lists at once.
+INDEX_ADAPTERS_PAGE_SIZE = 50
+# junit.xml is sent in chunks of about this many characters.
+JUNIT_CHUNK_SIZE = 64 * 1024
+# While test cases are running, their times in junit.xml grow; let pollers see that this often.
+JUNIT_RUNNING_ETAG_SECONDS = 5
+# Distinguishes ETags from this process from those of an earlier run, as state versions restart.
+_ETAG_INSTANCE = uuid.uuid4().hex[:8]
+
 
 @bp.route("/", methods=["GET"])
+@cached_render
 async def index():  # type: ignore
     return await render_template(
         "status_index.j2.html",
-        completed_adapters=get_adapters(True),
-        inprogress_adapters=get_adapters(False),
-        tests=get_tests(),
-        test_suites=get_testsuites(),
+        completed_adapters=query.adapters(
+            states=("completed",),
+            cursor=request.args.get("completed_cursor", default=0, type=int),
+            limit=INDEX_ADAPTERS_PAGE_SIZE,
+        ),
+        inprogress_adapters=query.adapters(
+            states=("available", "busy"),
+            cursor=request.args.get("inprogress_cursor", default=0, type=int),
+            limit=INDEX_ADAPTERS_PAGE_SIZE,
+        ),
+        test_suites=query.testsuites(limit=query.MAX_PAGE_SIZE).items,
+        homeserver_capacity=current_app.config["homerunner"].capacity_status(),
+        action_durations=list(metrics.action_duration_seconds.items()),
+        last_event_id=events.last_id(),
     )
 
 
 @bp.route("/junit.xml", methods=["GET"])
 async def as_junit():  # type: ignore
-    # for now we assume there's only one test; when we add the second we'll need to expand this logic a bit.
-    testsuites: List[TestSuite] = get_testsuites()
-
-    errors = 0 + sum(suite.errors() for suite in testsuites)
-    failures = 0 + sum(suite.failures() for suite in testsuites)
-    skipped = 0 + sum(suite.waiting() for suite in testsuites)
-    test_count = 0 + sum(len(suite.test_cases or []) for suite in testsuites)
-
-    return await render_template(
-        "junit.j2.xml",
-        testsuites=testsuites,
-        errors=errors,
-        failures=failures,
-        skipped=skipped,
-        tests=test_count,
-    )
+    # The document only changes when a test case does, except for the times of running test cases.
+    etag = f"{_ETAG_INSTANCE}-{events.state_version()}"
+    if get_state_counts().count("running"):
+        etag += f"-{int(time.time() // JUNIT_RUNNING_ETAG_SECONDS)}"
+
+    async def chunks() -> AsyncIterator[str]:
+        buffered: List[str] = []
+        size = 0
+        for piece in junit.iter_junit():
+            buffered.append(piece)
+            size += len(piece)
+            if size >= JUNIT_CHUNK_SIZE:
+                yield "".join(buffered)
+                buffered.clear()
+                size = 0
+                # Let adapter requests in between chunks of a large export.
+                await asyncio.sleep(0)
+        yield "".join(buffered)
+
+    response = Response(chunks(), content_type="application/xml")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return await response.make_conditional(request)
 
 
 @bp.route("/<string:guid>/files/<string:name>", methods=["GET"])
 async def test_file(guid: str, name: str):  # type: ignore
     test = get_test_case(guid)
     logger.info("Getting ${guid} ${name}")
-    if name in test.files:
-        path = test.files[name]
-        return await send_file(path)
+    artifact = test.files.get(name) if test is not None else None
+    if artifact is not None and artifact.exists():
+        return await send_file(
+            artifact.path,
+            mimetype=mimetypes.guess_type(name)[0] or "application/octet-stream",
+        )
     else:
+        # Either never uploaded, or deleted to keep the artifact store under its limit.
         abort(404)
 
 
 @bp.route("/<string:guid>/suitestatus", methods=["GET"])
+@cached_render
 async def testsuite_status(guid: str):  # type: ignore
-    refresh = request.args.get("refresh", default=0, type=int)
     testsuite = get_testsuite(guid)
     if testsuite is not None:
+        # Accepts the same filters as /status/api/test_cases
+        filters = page_args()
+        filters["suite"] = testsuite.name()
         return await render_template(
-            "status_suite.j2.html", testsuite=testsuite, refresh=refresh
+            "status_suite.j2.html",
+            testsuite=testsuite,
+            test_cases=query.test_cases(**filters),
+            states=filters["states"],
+            last_event_id=events.last_id(),
         )
     else:
         abort(404)
 
 
 @bp.route("/<string:guid>/status", methods=["GET"])
+@cached_render
 async def testcase_status(guid: str):  # type: ignore
-    refresh = request.args.get("refresh", default=0, type=int)
     logger.info("Finding test %s", guid)
     test = get_test_case(guid)
     if test is not None:
-        return await render_template("status_case.j2.html", test=test, refresh=refresh)
+        return await render_template(
+            "status_case.j2.html", test=test, last_event_id=events.last_id()
+        )
     else:
         abort(404)
+
+
+@bp.route("/events", methods=["GET"])
+async def live_events():  # type: ignore
+    """
+    Server-sent events for changes to test cases and adapters, for status pages to update themselves.
+
+    Starts after the event given by the Last-Event-ID header (when reconnecting) or the since
+    parameter (the event a page was rendered at), and only sends events for the test case or suite
+    given by the test or suite parameters. If events have been missed, sends a "reset" event and ends.
+    """
+    last_event_id = request.headers.get(
+        "Last-Event-ID", request.args.get("since", default=events.last_id())
+    )
+    try:
+        start = int(last_event_id)
+    except ValueError:
+        abort(400)
+    suite = request.args.get("suite")
+    test = request.args.get("test")
+
+    async def stream() -> AsyncIterator[str]:
+        event_id = start
+        while not events.closed():
+            pending = events.since(event_id)
+            if pending is None:
+                yield "event: reset\ndata: {}\n\n"
+                return
+            for event in pending:
+                event_id = event.id
+                if suite is not None and event.data.get("suite") != suite:
+                    continue
+                if test is not None and event.data.get("test_case") != test:
+                    continue
+                yield event.to_sse()
+            if not await events.wait(event_id, EVENT_STREAM_KEEPALIVE_SECONDS):
+                yield ": keepalive\n\n"
+
+    response = Response(
+        stream(),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+    response.timeout = None
+    return response
@@ -0,0 +1,177 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, TypeVar
+
+from quart import Blueprint, abort, request
+
+import trafficlight.query as query
+from trafficlight.internals.adapter import Adapter
+from trafficlight.internals.testcase import TestCase
+from trafficlight.internals.testsuite import TestSuite
+from trafficlight.store import get_adapter, get_test_case, get_testsuite
+
+logger = logging.getLogger(__name__)
+
+bp = Blueprint("status_api", __name__, url_prefix="/status/api")
+
+T = TypeVar("T")
+
+
+def states_arg() -> List[str]:
+    # Either repeated (?state=running&state=waiting) or comma separated (?state=running,waiting)
+    return [
+        state for value in request.args.getlist("state") for state in value.split(",")
+    ]
+
+
+def time_arg(name: str) -> Optional[datetime]:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, f"{name} must be an ISO 8601 time")
+
+
+def page_args() -> Dict[str, Any]:
+    """
+    The filters and cursor shared by every listing, as keyword arguments for the trafficlight.query functions.
+    """
+    return {
+        "states": states_arg(),
+        "client_type": request.args.get("client_type"),
+        "suite": request.args.get("suite"),
+        "since": time_arg("since"),
+        "until": time_arg("until"),
+        "cursor": request.args.get("cursor", default=0, type=int),
+        "limit": request.args.get("limit", default=query.DEFAULT_PAGE_SIZE, type=int),
+    }
+
+
+def _page_json(
+    page: query.Page[T], to_json: Callable[[T], Dict[str, Any]]
+) -> Dict[str, Any]:
+    return {
+        "items": [to_json(item) for item in page.items],
+        "next_cursor": page.next_cursor,
+    }
+
+
+def _seconds(value: Optional[timedelta]) -> Optional[float]:
+    return value.total_seconds() if value is not None else None
+
+
+def _time(value: datetime) -> str:
+    return value.isoformat()
+
+
+def testsuite_json(testsuite: TestSuite) -> Dict[str, Any]:
+    return {
+        "guid": testsuite.guid,
+        "name": testsuite.name(),
+        "total": testsuite.counts.total,
+        "waiting": testsuite.waiting(),
+        "running": testsuite.running(),
+        "success": testsuite.successes(),
+        "failed": testsuite.failures(),
+        "error": testsuite.errors(),
+    }
+
+
+def test_case_json(test_case: TestCase) -> Dict[str, Any]:
+    return {
+        "guid": test_case.guid,
+        "suite": test_case.test.name(),
+        "suite_guid": test_case.suite_guid,
+        "description": test_case.description(),
+        "server_type": str(test_case.server_type) if test_case.server_type else None,
+        "client_types": {
+            name: client_type.name()
+            for name, client_type in test_case.client_types.items()
+        },
+        "state": test_case.state,
+        "transitions": [
+            {"state": state, "at": _time(at)} for state, at in test_case.transitions
+        ],
+        "queue_time": _seconds(test_case.queue_time()),
+        "setup_time": _seconds(test_case.setup_time()),
+        "run_time": _seconds(test_case.run_time()),
+        "adapters": {
+            name: adapter.guid for name, adapter in (test_case.adapters or {}).items()
+        },
+        "files": list(test_case.files.keys()),
+        "exceptions": test_case.exceptions,
+    }
+
+
+def adapter_json(adapter: Adapter) -> Dict[str, Any]:
+    return {
+        "guid": adapter.guid,
+        "registration": adapter.registration,
+        "state": adapter.state(),
+        "test_case": adapter.client.test_case.guid if adapter.client else None,
+        "client": adapter.client.name if adapter.client else None,
+        "registered": _time(adapter.registered),
+        "last_polled": _time(adapter.last_polled),
+        "last_responded": _time(adapter.last_responded),
+        "last_error": str(adapter.last_error) if adapter.last_error else None,
+    }
+
+
+@bp.route("/suites", methods=["GET"])
+async def list_testsuites():  # type: ignore
+    page = query.testsuites(
+        name=request.args.get("suite"),
+        cursor=request.args.get("cursor", default=0, type=int),
+        limit=request.args.get("limit", default=query.DEFAULT_PAGE_SIZE, type=int),
+    )
+    return _page_json(page, testsuite_json)
+
+
+@bp.route("/suites/<string:guid>", methods=["GET"])
+async def show_testsuite(guid: str):  # type: ignore
+    testsuite = get_testsuite(guid)
+    if testsuite is None:
+        abort(404)
+    return testsuite_json(testsuite)
+
+
+@bp.route("/test_cases", methods=["GET"])
+async def list_test_cases():  # type: ignore
+    return _page_json(query.test_cases(**page_args()), test_case_json)
+
+
+@bp.route("/test_cases/<string:guid>", methods=["GET"])
+async def show_test_case(guid: str):  # type: ignore
+    test_case = get_test_case(guid)
+    if test_case is None:
+        abort(404)
+    return test_case_json(test_case)
+
+
+@bp.route("/adapters", methods=["GET"])
+async def list_adapters():  # type: ignore
+    return _page_json(query.adapters(**page_args()), adapter_json)
+
+
+@bp.route("/adapters/<string:guid>", methods=["GET"])
+async def show_adapter(guid: str):  # type: ignore
+    adapter = get_adapter(guid)
+    if adapter is None:
+        abort(404)
+    return adapter_json(adapter)
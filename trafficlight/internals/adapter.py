@@ -1,7 +1,12 @@
+import asyncio
 import logging
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
+import trafficlight.events as events
+import trafficlight.metrics as metrics
+import trafficlight.scheduler as scheduler
+from trafficlight.artifacts import Artifact
 from trafficlight.internals.client import Client
 
 logger = logging.getLogger(__name__)
@@ -20,17 +25,79 @@ class Adapter(object):
         # After allocation to a TestCase, this becomes valid and is where
         # updates should be passed to.
         self.client: Optional[Client] = None
+        # The pool tracking whether this adapter is available, if any.
+        self.pool: Optional[AdapterPool] = None
+        # Set (and replaced) whenever the result of poll() may have changed.
+        self._changed = asyncio.Event()
+        # The state this adapter was last reported in, while it is registered.
+        self._tracked_state: Optional[str] = None
+        # The id of the action last pushed to this adapter over a websocket.
+        self._pushed_action_id: Optional[str] = None
 
     def __repr__(self) -> str:
         return f"{self.guid} {self.registration}"
 
     def available(self) -> bool:
-        return self.client is None
+        return self.client is None and not self.completed
+
+    def bucket_key(self) -> Tuple[str, str]:
+        return str(self.registration["type"]), str(self.registration.get("version", ""))
+
+    def state(self) -> str:
+        if self.completed:
+            return "completed"
+        if self.client is None:
+            return "available"
+        return "busy"
+
+    def track_state(self, registered: bool = True) -> None:
+        """
+        Report this adapter's state to metrics and status pages, or report it removed once unregistered.
+        """
+        state = self.state() if registered else None
+        if state == self._tracked_state:
+            return
+        adapter_type = str(self.registration.get("type"))
+        if self._tracked_state is not None:
+            metrics.adapters.labels(adapter_type, self._tracked_state).dec()
+        if state is not None:
+            metrics.adapters.labels(adapter_type, state).inc()
+        self._tracked_state = state
+        events.state_changed()
+        events.publish(
+            "adapter",
+            adapter=self.guid,
+            type=adapter_type,
+            state=state or "removed",
+            test_case=self.client.test_case.guid if self.client else None,
+            client=self.client.name if self.client else None,
+            error=str(self.last_error) if self.last_error else None,
+        )
+
+    def _availability_changed(self) -> None:
+        if self.pool is not None:
+            self.pool.update(self)
+        if self._tracked_state is not None:
+            self.track_state()
+        self._poll_changed()
+
+    def _poll_changed(self) -> None:
+        # Wake everything waiting on the current event, then start a new one for later waiters.
+        self._changed.set()
+        self._changed = asyncio.Event()
 
     def finished(self) -> None:
         self.completed = True
+        self._availability_changed()
+        scheduler.notify("adapter completed")
 
-    def poll(self, update_last_polled: bool = True) -> Dict[str, Any]:
+    def poll(self, update_last_polled: bool = True, batch: int = 0) -> Dict[str, Any]:
+        """
+        Get the next action for this adapter.
+
+        @param update_last_polled: False to look at the next action without the adapter polling, eg for status pages.
+        @param batch: if more than zero, hand out up to this many queued actions at once as a "batch" action.
+        """
         if self.completed:
             action: Dict[str, Any] = {
                 "action": "exit",
@@ -42,14 +109,70 @@ class Adapter(object):
                 "action": "idle",
                 "data": {"delay": "30000", "reason": "waiting for testcase"},
             }
+        elif batch > 0 and update_last_polled:
+            action = self.client._get_poll_batch(batch)
         else:
-            action = self.client._get_poll_data()
+            action = self.client._get_poll_data(peek=not update_last_polled)
 
         if update_last_polled:
             self.last_polled = datetime.now()
 
         return action
 
+    def next_push(self) -> Optional[Dict[str, Any]]:
+        """
+        The next action to push to a connected adapter, or None if there is nothing new to push.
+
+        An action is pushed once; the action after it is pushed once the adapter has responded
+        to it, however the response arrived. Pushing doesn't count as the adapter polling.
+        """
+        if self.completed:
+            if self._pushed_action_id == "exit":
+                return None
+            self._pushed_action_id = "exit"
+            return self.poll(update_last_polled=False)
+        if self.client is None:
+            return None
+        next_action = self.client._get_poll_data(peek=True)
+        if (
+            next_action["action"] == "idle"
+            or next_action["id"] == self._pushed_action_id
+        ):
+            return None
+        self._pushed_action_id = next_action["id"]
+        # Hand the action out as a poll would now it is being sent, so it counts as picked up.
+        return self.client._get_poll_data()
+
+    def change_event(self) -> asyncio.Event:
+        """
+        An event that is set the next time the result of poll() may change.
+
+        Fetch the event before calling poll(), so a change between the two isn't missed.
+        """
+        return self._changed
+
+    async def wait_for_action(self, timeout: float, batch: int = 0) -> Dict[str, Any]:
+        """
+        Poll, but while the adapter would be told to idle, wait up to timeout seconds for something to do.
+
+        Returns as soon as an action is available (or the adapter is told to exit), otherwise
+        returns the idle action once the timeout has passed.
+        @param timeout: the most time to wait, in seconds.
+        @param batch: as for poll()
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            changed = self.change_event()
+            action = self.poll(batch=batch)
+            remaining = deadline - loop.time()
+            if action["action"] != "idle" or remaining <= 0:
+                return action
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
     def respond(
         self,
         update: Dict[str, Any],
@@ -60,6 +183,8 @@ class Adapter(object):
             raise Exception("Adapter %s has not been assigned a client yet", self.guid)
         update["_files"] = files
         self.client._give_poll_response(update)
+        # The next queued action (if any) is now what poll() returns.
+        self._poll_changed()
         if update_last_responded:
             self.last_responded = datetime.now()
 
@@ -71,6 +196,9 @@ class Adapter(object):
         # If we error, always mark us as completed
         self.completed = True
         self.last_error = error
+        metrics.adapter_errors.labels(str(self.registration.get("type"))).inc()
+        self._availability_changed()
+        scheduler.notify("adapter completed")
 
         logger.info("%s had an error: %s", self.guid, str(error))
 
@@ -85,7 +213,9 @@ class Adapter(object):
 
         self.client._give_poll_exception(error)
 
-    def upload(self, name: str, path: str, update_last_responded: bool = True) -> None:
+    def upload(
+        self, name: str, artifact: Artifact, update_last_responded: bool = True
+    ) -> None:
         if self.client is None:
             raise Exception("Adapter %s has not been assigned a client yet", self.guid)
 
@@ -94,10 +224,12 @@ class Adapter(object):
             self.guid,
             self.client.name,
             name,
-            path,
+            artifact.path,
         )
         # TODO link up to testCase somehow
-        self.client.test_case.files[self.client.name + "_" + name] = path
+        file_name = self.client.name + "_" + name
+        self.client.test_case.files[file_name] = artifact
+        events.publish("file", test_case=self.client.test_case.guid, name=file_name)
 
         if update_last_responded:
             self.last_responded = datetime.now()
@@ -105,3 +237,75 @@ class Adapter(object):
     def set_client(self, client: Client) -> None:
         logger.info("Allocate adapter %s to %s", self.guid, client)
         self.client = client
+        client.action_listener = self._poll_changed
+        self._availability_changed()
+
+
+class AdapterPool(object):
+    """
+    Available adapters, bucketed by registration type and then version.
+
+    Adapters in the same bucket are interchangeable when allocating them to test cases,
+    so allocation can look up the buckets for a type rather than scan every adapter.
+    """
+
+    def __init__(self, adapters: Iterable[Adapter] = ()) -> None:
+        self._buckets: Dict[str, Dict[str, Dict[str, Adapter]]] = {}
+        self._size = 0
+        for adapter in adapters:
+            self.add(adapter)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __repr__(self) -> str:
+        return f"AdapterPool({self.bucket_sizes()})"
+
+    def add(self, adapter: Adapter) -> None:
+        adapter_type, version = adapter.bucket_key()
+        bucket = self._buckets.setdefault(adapter_type, {}).setdefault(version, {})
+        if adapter.guid not in bucket:
+            bucket[adapter.guid] = adapter
+            self._size += 1
+
+    def discard(self, adapter: Adapter) -> None:
+        adapter_type, version = adapter.bucket_key()
+        versions = self._buckets.get(adapter_type, {})
+        bucket = versions.get(version, {})
+        if bucket.pop(adapter.guid, None) is not None:
+            self._size -= 1
+            if not bucket:
+                del versions[version]
+            if not versions:
+                del self._buckets[adapter_type]
+
+    def update(self, adapter: Adapter) -> None:
+        if adapter.available():
+            self.add(adapter)
+        else:
+            self.discard(adapter)
+
+    def bucket_keys(self, adapter_type: str) -> List[Tuple[str, str]]:
+        return [
+            (adapter_type, version) for version in self._buckets.get(adapter_type, {})
+        ]
+
+    def bucket(self, key: Tuple[str, str]) -> List[Adapter]:
+        adapter_type, version = key
+        return list(self._buckets.get(adapter_type, {}).get(version, {}).values())
+
+    def bucket_size(self, key: Tuple[str, str]) -> int:
+        adapter_type, version = key
+        return len(self._buckets.get(adapter_type, {}).get(version, {}))
+
+    def get(self, adapter_type: str, version: Optional[str] = None) -> List[Adapter]:
+        versions = self._buckets.get(adapter_type, {})
+        if version is not None:
+            return list(versions.get(version, {}).values())
+        return [adapter for bucket in versions.values() for adapter in bucket.values()]
+
+    def bucket_sizes(self) -> Dict[str, Dict[str, int]]:
+        return {
+            adapter_type: {version: len(bucket) for version, bucket in versions.items()}
+            for adapter_type, versions in self._buckets.items()
+        }
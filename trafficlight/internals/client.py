@@ -5,11 +5,13 @@ import string
 import time
 from dataclasses import dataclass
 from enum import StrEnum
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from nio import AsyncClient
 from PIL import Image  # type: ignore
 
+import trafficlight.events as events
+import trafficlight.metrics as metrics
 from trafficlight.homerunner import HomeServer
 from trafficlight.internals.exceptions import ActionException
 
@@ -26,6 +28,40 @@ class User:
         self.user_id = user_id
 
 
+@dataclass
+class QueuedAction:
+    action_id: str
+    question: Dict[str, Any]
+    future: "asyncio.Future[Dict[str, Any]]"
+    # True if the test is waiting on this action via _perform_action
+    awaited: bool
+    # True once handed to the adapter as part of a batch
+    batched: bool = False
+    # When the action was queued and first handed to the adapter, in seconds since the epoch
+    queued_at: float = 0.0
+    picked_up_at: Optional[float] = None
+
+    def to_poll_response(self) -> Dict[str, Any]:
+        if self.picked_up_at is None:
+            self.picked_up_at = time.time()
+        return {**self.question, "id": self.action_id}
+
+
+@dataclass
+class ActionTiming:
+    """
+    When one action was queued, picked up by the adapter and responded to, in seconds since the epoch.
+    """
+
+    client: str
+    action: str
+    queued: float
+    picked_up: Optional[float]
+    responded: float
+    # True if the adapter reported an error rather than responding
+    error: bool = False
+
+
 class Client:
     def __init__(
         self,
@@ -37,56 +73,167 @@ class Client:
         self.test_case = test_case
         self.registration = registration
 
-        self.current_poll_response = DEFAULT_POLL_RESPONSE
-        self.current_poll_future: Optional[asyncio.Future[Dict[str, Any]]] = None
+        # Actions waiting for a response from the adapter, oldest first.
+        self.queued_actions: Dict[str, QueuedAction] = {}
+        self._next_action_id = 0
 
         # Store an exception if if comes in while we're not awaiting something
         self.next_exception: Exception = None
 
+        # Called whenever a new action is available to poll, eg to wake long-polling adapters.
+        self.action_listener: Optional[Callable[[], None]] = None
+
     def __repr__(self) -> str:
         return self.name
 
     # Called by the http client API
-    def _get_poll_data(self) -> Dict[str, Any]:
-        return self.current_poll_response
+    def _get_poll_data(self, peek: bool = False) -> Dict[str, Any]:
+        # Without batching, the adapter works on the oldest action until it responds.
+        for queued_action in self.queued_actions.values():
+            if peek:
+                # eg for status pages; the adapter hasn't picked this action up.
+                return {**queued_action.question, "id": queued_action.action_id}
+            return queued_action.to_poll_response()
+        return DEFAULT_POLL_RESPONSE
+
+    # Called by the http client API
+    def _get_poll_batch(self, limit: int) -> Dict[str, Any]:
+        # With batching, each action is handed out once, in order, in batches of up to limit actions.
+        actions: List[Dict[str, Any]] = []
+        for queued_action in self.queued_actions.values():
+            if len(actions) >= limit:
+                break
+            if not queued_action.batched:
+                queued_action.batched = True
+                actions.append(queued_action.to_poll_response())
+        if not actions:
+            return DEFAULT_POLL_RESPONSE
+        return {"action": "batch", "data": {"actions": actions}}
 
     # Called by the http client API
     def _give_poll_response(self, data: Dict[str, Any]) -> None:
-        if self.current_poll_future is not None:
-            self.current_poll_future.set_result(data)
-        else:
+        if "responses" in data:
+            for response in data["responses"]:
+                self._give_poll_response({"_files": data.get("_files", {}), **response})
+            return
+
+        # Responses are routed by action id; without one, they answer the oldest action.
+        action_id = data.get("id")
+        if action_id is None:
+            action_id = next(iter(self.queued_actions), None)
+        queued_action = self.queued_actions.pop(str(action_id), None)
+        if queued_action is None:
             raise Exception("Unable to handle response; not awaiting that.")
 
         # resolve the promise s.t. register returns
+        self._record_timing(queued_action, error=False)
+        queued_action.future.set_result(data)
 
     def _give_poll_exception(self, exception: Exception) -> None:
-        if self.current_poll_future is not None:
-            self.current_poll_future.set_exception(exception)
-        else:
+        queued_actions = list(self.queued_actions.values())
+        self.queued_actions.clear()
+        for queued_action in queued_actions:
+            self._record_timing(queued_action, error=True)
+            queued_action.future.set_exception(exception)
+        if not any(queued_action.awaited for queued_action in queued_actions):
             # Store exception for next time we perform an action.
             self.next_exception = exception
 
-    # used by named methods from the test
-    async def _perform_action(self, question: Dict[str, Any]) -> Dict[str, Any]:
-        if self.current_poll_future is not None:
-            raise Exception(
-                "Action collision: already waiting for response to "
-                + str(self.current_poll_response)
+    def queue_action(
+        self, question: Dict[str, Any]
+    ) -> "asyncio.Future[Dict[str, Any]]":
+        """
+        Queue an action for the adapter without waiting for it to complete.
+
+        Actions are performed in the order they are queued; use flush_actions() to wait for
+        them all. If a queued action fails, the exception is raised by the next action or flush.
+        @return: a future resolving to the adapter's response.
+        """
+        future = self._enqueue(question, awaited=False).future
+        # Failures are surfaced via next_exception, so don't warn if nobody awaits the future
+        future.add_done_callback(lambda f: f.exception() if not f.cancelled() else None)
+        return future
+
+    async def flush_actions(self) -> None:
+        """
+        Wait for every queued action to complete, raising the first failure if any.
+        """
+        futures = [
+            queued_action.future for queued_action in self.queued_actions.values()
+        ]
+        outcomes = await asyncio.gather(*futures, return_exceptions=True)
+        # Raising the stored failure clears it, so the next action doesn't raise it again.
+        self._raise_next_exception()
+        for outcome in outcomes:
+            if isinstance(outcome, BaseException):
+                raise outcome
+
+    def _record_timing(self, queued_action: QueuedAction, error: bool) -> None:
+        timing = ActionTiming(
+            client=self.name,
+            action=str(queued_action.question.get("action")),
+            queued=queued_action.queued_at,
+            picked_up=queued_action.picked_up_at,
+            responded=time.time(),
+            error=error,
+        )
+        self.test_case.action_timings.append(timing)
+        events.publish(
+            "action",
+            test_case=self.test_case.guid,
+            client=timing.client,
+            action=timing.action,
+            waited=timing.picked_up - timing.queued if timing.picked_up else None,
+            took=timing.responded - timing.queued,
+            error=error,
+        )
+        if error:
+            return
+        adapter_type = str(self.registration.get("type"))
+        if timing.picked_up is not None:
+            metrics.action_wait_seconds.labels(timing.action, adapter_type).observe(
+                timing.picked_up - timing.queued
             )
+        metrics.action_duration_seconds.labels(timing.action, adapter_type).observe(
+            timing.responded - timing.queued
+        )
 
+    def _raise_next_exception(self) -> None:
         if self.next_exception is not None:
             exception = self.next_exception
             self.next_exception = None
             raise exception
 
-        self.current_poll_response = question
-        self.current_poll_future = asyncio.get_running_loop().create_future()
+    def _enqueue(self, question: Dict[str, Any], awaited: bool) -> QueuedAction:
+        self._raise_next_exception()
+
+        self._next_action_id += 1
+        queued_action = QueuedAction(
+            action_id=str(self._next_action_id),
+            question=question,
+            future=asyncio.get_running_loop().create_future(),
+            awaited=awaited,
+            queued_at=time.time(),
+        )
+        self.queued_actions[queued_action.action_id] = queued_action
+        if self.action_listener is not None:
+            self.action_listener()
+        return queued_action
+
+    # used by named methods from the test
+    async def _perform_action(self, question: Dict[str, Any]) -> Dict[str, Any]:
+        for queued_action in self.queued_actions.values():
+            if queued_action.awaited:
+                raise Exception(
+                    "Action collision: already waiting for response to "
+                    + str(queued_action.question)
+                )
 
+        queued_action = self._enqueue(question, awaited=True)
         try:
-            rsp = await self.current_poll_future
+            rsp = await queued_action.future
         finally:
-            self.current_poll_future = None
-            self.current_poll_response = DEFAULT_POLL_RESPONSE
+            self.queued_actions.pop(queued_action.action_id, None)
 
         return rsp
 
@@ -287,7 +434,7 @@ class ElementCallClient(Client):
         response = await self._perform_action({"action": "get_lobby_data", "data": {}})
 
         data = response["data"]
-        snapshot_file = self.test_case.files[self.name + "_" + data["snapshot"]]
+        snapshot_file = self.test_case.files[self.name + "_" + data["snapshot"]].path
         invite_url = response["data"]["invite_url"]
         page_url = response["data"]["page_url"]
         # Strip trailing & on page URLs until https://github.com/vector-im/element-call/issues/1639 is resolved
@@ -317,7 +464,9 @@ class ElementCallClient(Client):
         tiles: List[VideoTile] = []
         for video in videos:
             # convert from adapter naming to our naming.
-            snapshot_file = self.test_case.files[self.name + "_" + video["snapshot"]]
+            snapshot_file = self.test_case.files[
+                self.name + "_" + video["snapshot"]
+            ].path
             tiles.append(
                 VideoTile(
                     caption=video["caption"],
@@ -504,6 +653,11 @@ class MatrixClient(Client):
             {"action": "send_message", "data": {"message": message}}
         )
 
+    def queue_send_message(self, message: str) -> "asyncio.Future[Dict[str, Any]]":
+        return self.queue_action(
+            {"action": "send_message", "data": {"message": message}}
+        )
+
     async def invite_user(self, user_id: str) -> None:
         await self._perform_action(
             {"action": "invite_user", "data": {"userId": user_id}}
@@ -42,3 +42,11 @@ class ShutdownException(Exception):
     """
 
     pass
+
+
+class InvalidStateTransition(Exception):
+    """
+    Raised when a test case is moved to a state that cannot follow its current state.
+    """
+
+    pass
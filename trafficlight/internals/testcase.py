@@ -1,23 +1,83 @@
 import hashlib
 import logging
+import time
 import traceback
-from typing import Any, Dict, List, Optional, Union
+from datetime import datetime, timedelta
+from enum import StrEnum
+from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
+import trafficlight.events as events
 import trafficlight.kiwi as kiwi
+import trafficlight.scheduler as scheduler
+from trafficlight.artifacts import Artifact
 from trafficlight.client_types import ClientType
-from trafficlight.homerunner import HomerunnerClient, HomeServer
+from trafficlight.homerunner import HomerunnerClient, HomerunnerError, HomeServer
 from trafficlight.internals.adapter import Adapter
 from trafficlight.internals.client import (
+    ActionTiming,
     ElementCallClient,
     MatrixClient,
     NetworkProxyClient,
 )
-from trafficlight.internals.exceptions import ActionException, AdapterException
+from trafficlight.internals.exceptions import (
+    ActionException,
+    AdapterException,
+    InvalidStateTransition,
+)
 from trafficlight.server_types import ServerType
 
 logger = logging.getLogger(__name__)
 
 
+class TestCaseState(StrEnum):
+    WAITING = "waiting"
+    PREPARING = "preparing"
+    RUNNING = "running"
+    SUCCESS = "success"
+    FAILED = "failed"
+    ERROR = "error"
+
+    def finished(self) -> bool:
+        return not _TRANSITIONS[self]
+
+
+_TRANSITIONS: Dict[TestCaseState, Set[TestCaseState]] = {
+    TestCaseState.WAITING: {TestCaseState.PREPARING},
+    # Errors while preparing are setup failures, eg homeservers that never became ready.
+    TestCaseState.PREPARING: {TestCaseState.RUNNING, TestCaseState.ERROR},
+    TestCaseState.RUNNING: {
+        TestCaseState.SUCCESS,
+        TestCaseState.FAILED,
+        TestCaseState.ERROR,
+    },
+    TestCaseState.SUCCESS: set(),
+    TestCaseState.FAILED: set(),
+    TestCaseState.ERROR: set(),
+}
+
+
+class StateCounts(object):
+    """
+    How many of a group of test cases are in each state, kept up to date by TestCase.set_state().
+    """
+
+    def __init__(self) -> None:
+        self._counts: Dict[str, int] = {}
+        self.total = 0
+
+    def add(self, test_case: "TestCase") -> None:
+        self._counts[test_case.state] = self._counts.get(test_case.state, 0) + 1
+        self.total += 1
+        test_case.counters.append(self)
+
+    def moved(self, from_state: str, to_state: str) -> None:
+        self._counts[from_state] -= 1
+        self._counts[to_state] = self._counts.get(to_state, 0) + 1
+
+    def count(self, *states: str) -> int:
+        return sum(self._counts.get(state, 0) for state in states)
+
+
 class TestCase:
     def __init__(
         self,
@@ -36,10 +96,27 @@ class TestCase:
         self.server_type = server_type
         self.server_names = server_names
         self.test = test
-        self.state = "waiting"
+        # Set by the TestSuite this test case belongs to.
+        self.suite_guid: Optional[str] = None
+        self.state = TestCaseState.WAITING
+        # Each state this test case has been in, with when it moved to that state.
+        self.transitions: List[Tuple[TestCaseState, datetime]] = [
+            (self.state, datetime.now())
+        ]
+        # Counts including this test case, updated whenever its state changes.
+        self.counters: List[StateCounts] = []
         self.servers: List[HomeServer] = []
-        self.files: Dict[str, str] = {}
+        # Seconds spent getting homeservers, and how long each one took to answer once created.
+        self.server_create_time: Optional[float] = None
+        self.server_ready_times: Dict[str, float] = {}
+        # Files uploaded by the adapters, by client name and file name.
+        self.files: Dict[str, Artifact] = {}
+        # Every action the clients performed, in the order they finished.
+        self.action_timings: List[ActionTiming] = []
         self.adapters: Optional[Dict[str, Adapter]] = None
+        self.clients: Dict[
+            str, Union[MatrixClient, NetworkProxyClient, ElementCallClient]
+        ] = {}
 
     def __repr__(self) -> str:
         return f"{self.test.name()} ({self.server_type} {self.client_types})"
@@ -47,36 +124,63 @@ class TestCase:
     def description(self) -> str:
         return f"{self.server_type} {self.client_types}"
 
-    def allocate_adapters(
-        self, available_adapters: List[Adapter]
-    ) -> Optional[Dict[str, Adapter]]:
+    def set_state(self, state: TestCaseState) -> None:
         """
-        Return None if not enough adapters are found, otherwise return list of adapters i need
-        @param available_adapters:
-        @return:
+        Move this test case to a new state, recording when it did.
+
+        @raise InvalidStateTransition: if state cannot follow the current state.
         """
-        remaining_adapters = list(available_adapters)
-        used_adapters: Dict[str, Adapter] = {}
-        for client_var_name, client_type in self.client_types.items():
-            for adapter in remaining_adapters:
-                if client_type.match(adapter):
-                    remaining_adapters.remove(adapter)
-                    used_adapters[client_var_name] = adapter
-                    break
-            else:
-                return None
-        return used_adapters
+        previous = self.state
+        if state not in _TRANSITIONS[previous]:
+            raise InvalidStateTransition(
+                f"{self} cannot move from {previous} to {state}"
+            )
+        self.state = state
+        self.transitions.append((state, datetime.now()))
+        for counter in self.counters:
+            counter.moved(previous, state)
+        events.state_changed()
+        events.publish(
+            "test_case",
+            test_case=self.guid,
+            suite=self.suite_guid,
+            previous=previous,
+            state=state,
+        )
 
-    async def run(
-        self, adapters: Dict[str, Adapter], homerunner: HomerunnerClient
-    ) -> None:
-        self.state = "preparing"
+    def time_in(self, state: TestCaseState) -> Optional[timedelta]:
+        """
+        How long this test case spent in the given state, so far if it is still in it.
+
+        @return: None if the test case has not been in that state.
+        """
+        for index, (entered_state, entered) in enumerate(self.transitions):
+            if entered_state == state:
+                if index + 1 < len(self.transitions):
+                    return self.transitions[index + 1][1] - entered
+                return datetime.now() - entered
+        return None
+
+    def queue_time(self) -> Optional[timedelta]:
+        return self.time_in(TestCaseState.WAITING)
+
+    def setup_time(self) -> Optional[timedelta]:
+        return self.time_in(TestCaseState.PREPARING)
+
+    def run_time(self) -> Optional[timedelta]:
+        return self.time_in(TestCaseState.RUNNING)
+
+    def prepare(self, adapters: Dict[str, Adapter]) -> None:
+        """
+        Claim the given adapters for this test case and move it out of "waiting".
+
+        This is synchronous so the scheduler can claim adapters for a test case before
+        the next scheduling pass could hand the same adapters to another test case.
+        @param adapters: the allocation for this test case from a scheduling pass
+        """
+        self.set_state(TestCaseState.PREPARING)
         self.adapters = adapters
         # turn adapters into clients
-        kwargs: Dict[
-            str, Union[HomeServer, MatrixClient, NetworkProxyClient, ElementCallClient]
-        ] = {}
-
         for client_var_name, adapter in adapters.items():
             client: Union[MatrixClient, NetworkProxyClient, ElementCallClient]
             if adapter.registration["type"] == "network-proxy":
@@ -86,39 +190,56 @@ class TestCase:
             else:
                 client = MatrixClient(client_var_name, self, adapter.registration)
             adapter.set_client(client)
-            kwargs[client_var_name] = client
-        if self.server_type:
-            homeservers = await homerunner.create(self.guid, self.server_type)
-            for i in range(0, len(self.server_names)):
-                kwargs[self.server_names[i]] = homeservers[i]
+            self.clients[client_var_name] = client
+
+    async def run(self, homerunner: HomerunnerClient) -> None:
+        if self.adapters is None:
+            raise Exception("Test case has not been prepared with adapters")
+        adapters = self.adapters
+        kwargs: Dict[
+            str, Union[HomeServer, MatrixClient, NetworkProxyClient, ElementCallClient]
+        ] = dict(self.clients)
 
         # This may well bail out entirely if the configuration of the test is incorrect
         # But this is a badly written test so is actually OK.
         try:
+            if self.server_type:
+                started = time.monotonic()
+                homeservers = await homerunner.create(self.guid, self.server_type)
+                self.servers = homeservers
+                self.server_create_time = time.monotonic() - started
+                self.server_ready_times = await homerunner.wait_until_ready(homeservers)
+                for i in range(0, len(self.server_names)):
+                    kwargs[self.server_names[i]] = homeservers[i]
+
             logger.info(f"Test setup. Beginning run with kwargs {kwargs}")
-            self.state = "running"
+            self.set_state(TestCaseState.RUNNING)
             await self.test.run(**kwargs)
-            self.state = "success"
+            self.set_state(TestCaseState.SUCCESS)
         except AssertionError:
             # Treating a test that throws an assertionError as a failure
-            self.state = "failed"
+            self.set_state(TestCaseState.FAILED)
             self.exceptions.append("".join(traceback.format_exc()))
         except ActionException as e:
             # Treating an adapter that fails to perform an action as a failure
-            self.state = "failed"
+            self.set_state(TestCaseState.FAILED)
             self.exceptions.append(e.formatted_message)
+        except HomerunnerError as e:
+            # Homeservers could not be created or never became ready; the test never started
+            self.set_state(TestCaseState.ERROR)
+            self.exceptions.append(f"Homeserver setup failed: {e.homerunnerError}")
         except AdapterException as e:
             # Treating an adapter that causes another type of exception as an error
-            self.state = "error"
+            self.set_state(TestCaseState.ERROR)
             self.exceptions.append(e.formatted_message)
         except Exception:
             # Treating everything else as an error as well... eg compilation failures
-            self.state = "error"
+            self.set_state(TestCaseState.ERROR)
             self.exceptions.append("".join(traceback.format_exc()))
         finally:
             for adapter in adapters.values():
                 adapter.finished()
-            for server in self.servers:
-                server.finished()
+            homerunner.release(self.servers)
+            scheduler.notify("test case finished")
             if kiwi.kiwi_client:
-                await kiwi.kiwi_client.report_status(self)
+                kiwi.kiwi_client.report_status(self)
@@ -2,7 +2,7 @@ import hashlib
 from typing import List
 
 from trafficlight.internals.test import Test
-from trafficlight.internals.testcase import TestCase
+from trafficlight.internals.testcase import StateCounts, TestCase
 
 
 class TestSuite:
@@ -10,46 +10,28 @@ class TestSuite:
         self.guid = hashlib.md5(f"TestSuite{test.name()}".encode("utf-8")).hexdigest()
         self.test = test
         self.test_cases = test_cases
+        self.counts = StateCounts()
+        for test_case in test_cases or []:
+            test_case.suite_guid = self.guid
+            self.counts.add(test_case)
 
     def name(self) -> str:
         return self.test.name()
 
     def running(self) -> int:
-        if self.test_cases is not None:
-            return 0 + sum(1 for tc in self.test_cases if tc.state == "running")
-        return 0
+        return self.counts.count("running")
 
     def successes(self) -> int:
-        if self.test_cases is not None:
-            return 0 + sum(1 for tc in self.test_cases if tc.state == "success")
-        return 0
+        return self.counts.count("success")
 
     def failures(self) -> int:
-        if self.test_cases is not None:
-            return 0 + sum(1 for tc in self.test_cases if tc.state == "failed")
-        return 0
+        return self.counts.count("failed")
 
     def errors(self) -> int:
-        if self.test_cases is not None:
-            return 0 + sum(1 for tc in self.test_cases if tc.state == "error")
-        return 0
+        return self.counts.count("error")
 
     def waiting(self) -> int:
-        if self.test_cases is not None:
-            return 0 + sum(
-                1 for tc in self.test_cases if tc.state in ("waiting", "preparing")
-            )
-        return 0
+        return self.counts.count("waiting", "preparing")
 
     def done(self) -> bool:
-        if self.test_cases is not None:
-            return (
-                sum(
-                    1
-                    for tc in self.test_cases
-                    if tc.state in ("waiting", "preparing", "running")
-                )
-                > 0
-            )
-        else:
-            return False
+        return self.counts.count("waiting", "preparing", "running") > 0
@@ -0,0 +1,131 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+JUnit XML for the results of a run.
+
+The document is produced a test case at a time, so exporting a large matrix of test cases
+only ever holds one test case's XML (or one chunk of output) in memory.
+"""
+from __future__ import annotations
+
+import os
+import re
+import typing
+from datetime import timedelta
+from typing import Iterable, Iterator, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from trafficlight.store import get_state_counts, get_testsuites
+
+if typing.TYPE_CHECKING:
+    from trafficlight.internals.testcase import StateCounts, TestCase
+    from trafficlight.internals.testsuite import TestSuite
+
+# Test cases in these states have not finished, so they are reported as skipped.
+UNFINISHED_STATES = ("waiting", "preparing", "running")
+
+# Characters that may not appear in XML 1.0, eg terminal escapes in an adapter's error.
+_INVALID_XML_CHARACTERS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+
+def _text(value: str) -> str:
+    return escape(_INVALID_XML_CHARACTERS.sub("", value))
+
+
+def _attribute(value: str) -> str:
+    return quoteattr(_INVALID_XML_CHARACTERS.sub("", value))
+
+
+def _seconds(value: Optional[timedelta]) -> str:
+    if value is None:
+        return "0"
+    return "%.3f" % value.total_seconds()
+
+
+def _total_run_time(test_cases: Iterable[TestCase]) -> timedelta:
+    return sum(
+        (test_case.run_time() or timedelta() for test_case in test_cases), timedelta()
+    )
+
+
+def _counts(counts: StateCounts) -> str:
+    return (
+        f'tests="{counts.total}" failures="{counts.count("failed")}"'
+        f' errors="{counts.count("error")}" skipped="{counts.count(*UNFINISHED_STATES)}"'
+    )
+
+
+def _testcase(testsuite: TestSuite, test_case: TestCase) -> str:
+    # time is how long the test case ran for; setting up its homeservers is reported separately.
+    lines = [
+        f"    <testcase classname={_attribute(testsuite.name())}"
+        f" name={_attribute(test_case.description())} time={_attribute(_seconds(test_case.run_time()))}>"
+    ]
+    details = "\n".join(test_case.exceptions)
+    message = test_case.exceptions[-1].splitlines()[0] if details else test_case.state
+    if test_case.state == "failed":
+        lines.append(
+            f'      <failure message={_attribute(message)} type="failure">{_text(details)}</failure>'
+        )
+    elif test_case.state == "error":
+        lines.append(
+            f'      <error message={_attribute(message)} type="error">{_text(details)}</error>'
+        )
+    elif test_case.state in UNFINISHED_STATES:
+        lines.append(f"      <skipped message={_attribute(test_case.state)}/>")
+    setup = f"queued {_seconds(test_case.queue_time())}s, setup {_seconds(test_case.setup_time())}s"
+    if test_case.server_create_time is not None:
+        setup += f", homeservers created in {test_case.server_create_time:.3f}s"
+    lines.append(
+        f"      <system-out>{_text(f'{test_case.guid}: {setup}')}</system-out>"
+    )
+    lines.append("    </testcase>\n")
+    return "\n".join(lines)
+
+
+def iter_junit() -> Iterator[str]:
+    """
+    The JUnit XML document for every test suite, in pieces.
+    """
+    testsuites = get_testsuites()
+    total_time = _total_run_time(
+        test_case for testsuite in testsuites for test_case in testsuite.test_cases
+    )
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield (
+        f'<testsuites name="trafficlight" {_counts(get_state_counts())}'
+        f' time="{_seconds(total_time)}">\n'
+    )
+    # Each testsuite is a trafficlight test, and each testcase one of its parameterisations.
+    for testsuite in testsuites:
+        yield (
+            f"  <testsuite name={_attribute(testsuite.name())} {_counts(testsuite.counts)}"
+            f' time="{_seconds(_total_run_time(testsuite.test_cases))}">\n'
+        )
+        for test_case in testsuite.test_cases:
+            yield _testcase(testsuite, test_case)
+        yield "  </testsuite>\n"
+    yield "</testsuites>\n"
+
+
+def write_junit(path: str) -> None:
+    """
+    Write the JUnit XML document to a file, replacing it only once the document is complete.
+    """
+    partial_path = path + ".partial"
+    with open(partial_path, "w", encoding="utf-8") as junit_file:
+        for piece in iter_junit():
+            junit_file.write(piece)
+    os.replace(partial_path, path)
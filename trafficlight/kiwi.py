@@ -15,12 +15,18 @@
 from __future__ import annotations
 
 import asyncio
+import copy
+import json
 import logging
+import os
+import threading
 import typing
-from typing import List, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from tcms_api import plugin_helpers  # type: ignore
+from tcms_api import TCMS, plugin_helpers  # type: ignore
 
+import trafficlight.metrics as metrics
 import trafficlight.store
 
 if typing.TYPE_CHECKING:
@@ -28,6 +34,19 @@ if typing.TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Most Kiwi RPCs in flight at once; each runs on its own thread with its own connection.
+KIWI_RPC_CONCURRENCY = 8
+# Most results uploaded together; results are uploaded as soon as the previous batch is done.
+KIWI_BATCH_SIZE = 50
+# While Kiwi is failing, wait this long before retrying, doubling up to the maximum.
+KIWI_RETRY_INITIAL_DELAY = 1.0
+KIWI_RETRY_MAX_DELAY = 60.0
+# How long shutdown waits for the spool to be uploaded; anything left can be replayed later.
+KIWI_END_RUN_TIMEOUT = 30.0
+
+# The environment that picks the Kiwi product, version, build and run for a result.
+_RUN_ENVIRONMENT = ("TCMS_PRODUCT", "TCMS_PRODUCT_VERSION", "TCMS_BUILD", "TCMS_RUN_ID")
+
 
 class KiwiException(Exception):
     pass
@@ -51,19 +70,240 @@ def summarize_test_case(tl_test_case: TestCase) -> str:
     return summary
 
 
+def describe_test_case(tl_test_case: TestCase) -> str:
+    """
+    Describes the adapters and servers a finished testcase ran with, as a comment for its execution.
+    """
+    comment = "Adapters:\n"
+    for name, adapter in (tl_test_case.adapters or {}).items():
+        if adapter.client is not None:
+            comment += f"{name} = {adapter.client.name} {adapter.client.registration}\n"
+
+    comment += "Servers:\n"
+    for server in tl_test_case.servers:
+        comment += f"{server.server_name} = {server.cs_api}"
+    return comment
+
+
+class Spool(object):
+    """
+    An append-only file of test results to send to Kiwi, and of which ones have been sent.
+
+    Each line is a JSON object: either a result, or {"uploaded": <result id>} once that result
+    is in Kiwi. A result id is only ever uploaded once, and a later result with the same id
+    replaces one that hasn't been uploaded yet.
+
+    Lines are written and synced by a thread of the spool's own, in the order they were added,
+    so the event loop never waits on the disk. When loaded, the file is compacted to the results
+    still pending and the ids of those already uploaded.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.pending: Dict[str, Dict[str, Any]] = {}
+        self._uploaded: Set[str] = set()
+        # One thread, so lines are written in the order they were added.
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="spool")
+        self._closed = False
+        if os.path.exists(path):
+            self._load()
+            self._compact()
+        self._pending_changed()
+
+    def _load(self) -> None:
+        with open(self.path) as spool_file:
+            for line in spool_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Eg a line cut short by a crash; the result will have been lost, but nothing else.
+                    logger.warning(
+                        "Skipping unreadable line in %s: %r", self.path, line
+                    )
+                    continue
+                if "uploaded" in entry:
+                    self._uploaded.add(entry["uploaded"])
+                    self.pending.pop(entry["uploaded"], None)
+                elif entry["id"] not in self._uploaded:
+                    self.pending[entry["id"]] = entry
+
+    def _compact(self) -> None:
+        # Uploaded results are only needed as ids, so a spool doesn't grow with every run.
+        partial_path = self.path + ".partial"
+        with open(partial_path, "w") as spool_file:
+            for result_id in self._uploaded:
+                spool_file.write(json.dumps({"uploaded": result_id}) + "\n")
+            for result in self.pending.values():
+                spool_file.write(json.dumps(result) + "\n")
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        os.replace(partial_path, self.path)
+
+    def add(self, result: Dict[str, Any]) -> None:
+        if result["id"] in self._uploaded:
+            logger.info("Result %s has already been uploaded to Kiwi", result["id"])
+            return
+        self._append(result)
+        self.pending.pop(result["id"], None)
+        self.pending[result["id"]] = result
+        self._pending_changed()
+
+    def mark_uploaded(self, result_id: str) -> None:
+        self._append({"uploaded": result_id})
+        self._uploaded.add(result_id)
+        self.pending.pop(result_id, None)
+        self._pending_changed()
+
+    async def close(self) -> None:
+        """
+        Wait for every line added so far to be written; lines added later are written straight away.
+        """
+        self._closed = True
+        await asyncio.get_running_loop().run_in_executor(None, self._writer.shutdown)
+
+    def _pending_changed(self) -> None:
+        metrics.kiwi_pending_results.labels().set(len(self.pending))
+
+    def _append(self, entry: Dict[str, Any]) -> None:
+        line = json.dumps(entry) + "\n"
+        if self._closed:
+            # Eg a test case finishing during shutdown; its result must still be kept.
+            try:
+                self._write(line)
+            except OSError as e:
+                logger.error("Unable to write to %s: %s", self.path, e)
+            return
+        self._writer.submit(self._write, line).add_done_callback(self._written)
+
+    def _write(self, line: str) -> None:
+        with open(self.path, "a") as spool_file:
+            spool_file.write(line)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+    def _written(self, write: "Future[None]") -> None:
+        error = write.exception()
+        if error is not None:
+            # The result is still uploaded from memory if Kiwi can be reached.
+            logger.error("Unable to write to %s: %s", self.path, error)
+
+
 kiwi_client: Optional[KiwiClient] = None
 
 
 class KiwiClient(object):
-    def __init__(self, verbose: bool) -> None:
+    def __init__(self, verbose: bool, spool: Spool) -> None:
         self.backend = Backend(prefix="[trafficlight]", verbose=verbose)
         self.verbose = verbose
+        self.spool = spool
+        self._executor = ThreadPoolExecutor(
+            max_workers=KIWI_RPC_CONCURRENCY, thread_name_prefix="kiwi"
+        )
+        # The xmlrpc connection isn't thread safe, so each thread gets a copy of the
+        # configured backend with a connection of its own.
+        self._thread_local = threading.local()
+        self._configured = False
+        # Kiwi test execution ids for each test case summary.
+        self._executions: Dict[str, List[int]] = {}
+        self._run_environment: Dict[str, Optional[str]] = {}
+        self._worker: Optional[asyncio.Task[None]] = None
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
 
     async def start_run(self) -> None:
-        test_cases = trafficlight.store.get_tests()
-        await asyncio.to_thread(self._start_run_sync, test_cases)
+        """
+        Start uploading results in the background, first creating the run and registering every test case.
 
-    def _start_run_sync(self, test_cases: List[TestCase]) -> None:
+        Does not wait for Kiwi, which may be unavailable.
+        """
+        self._run_environment = {
+            name: os.environ.get(name) for name in _RUN_ENVIRONMENT
+        }
+        earlier = len(self.spool.pending) - len(self._pending_for_this_run())
+        if earlier:
+            logger.warning(
+                "%s results from earlier runs are waiting in %s; use `quart kiwi-replay` to upload them",
+                earlier,
+                self.spool.path,
+            )
+        self._worker = asyncio.create_task(
+            self._upload_loop(trafficlight.store.get_tests())
+        )
+
+    def report_status(self, tl_test_case: TestCase) -> None:
+        """
+        Record the result of a finished test case to be uploaded to Kiwi; this does not wait for Kiwi.
+        """
+        result = {
+            "id": f"{self._run_environment.get('TCMS_BUILD')}/{tl_test_case.guid}",
+            "environment": self._run_environment,
+            "run_id": self.backend.run_id,
+            "summary": summarize_test_case(tl_test_case),
+            "state": tl_test_case.state,
+            "comment": describe_test_case(tl_test_case),
+        }
+        self.spool.add(result)
+        self._drained.clear()
+        self._wakeup.set()
+
+    async def end_run(self) -> None:
+        """
+        Give the uploader a little time to finish, then close the run in Kiwi.
+
+        Gives up after KIWI_END_RUN_TIMEOUT, leaving anything not uploaded in the spool.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + KIWI_END_RUN_TIMEOUT
+        try:
+            await asyncio.wait_for(self._drained.wait(), KIWI_END_RUN_TIMEOUT)
+            await asyncio.wait_for(
+                self._run_rpc(self._end_run_sync), deadline - loop.time()
+            )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Kiwi did not finish in time; %s results are left in %s, use `quart kiwi-replay` to upload them",
+                len(self._pending_for_this_run()),
+                self.spool.path,
+            )
+        finally:
+            if self._worker is not None:
+                self._worker.cancel()
+                self._worker = None
+            self._executor.shutdown(wait=False)
+            await self.spool.close()
+
+    def _end_run_sync(self) -> None:
+        self._thread_backend().finish_test_run()
+
+    async def _upload_loop(self, test_cases: List[TestCase]) -> None:
+        delay = KIWI_RETRY_INITIAL_DELAY
+        while True:
+            self._wakeup.clear()
+            try:
+                if not self._configured:
+                    await self._start(test_cases)
+                await self._upload(self._pending_for_this_run())
+                delay = KIWI_RETRY_INITIAL_DELAY
+            except Exception:
+                logger.exception("Unable to upload to Kiwi; retrying in %ss", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, KIWI_RETRY_MAX_DELAY)
+                continue
+            if not self._pending_for_this_run():
+                self._drained.set()
+                await self._wakeup.wait()
+
+    async def _start(self, test_cases: List[TestCase]) -> None:
+        await self._run_rpc(self._configure)
+        # Register every test case with the run concurrently, remembering the executions created.
+        await asyncio.gather(
+            *[
+                self._register(summarize_test_case(tl_test_case))
+                for tl_test_case in test_cases
+            ]
+        )
+
+    def _configure(self) -> None:
         # Create test execution etc...
         self.backend.configure()
         self._status_map = {
@@ -71,47 +311,125 @@ class KiwiClient(object):
             "failed": self.backend.get_status_id("FAILED"),
             "success": self.backend.get_status_id("PASSED"),
         }
+        self._configured = True
 
-        # ensure test_cases exist in the given plan, but do not yet add them to the run.
-        for tl_test_case in test_cases:
-            kiwi_test_case, _ = self.backend.test_case_get_or_create(
-                summarize_test_case(tl_test_case)
+    def _pending_for_this_run(self) -> List[Dict[str, Any]]:
+        return [
+            result
+            for result in self.spool.pending.values()
+            if result["environment"] == self._run_environment
+        ]
+
+    async def _upload(self, results: List[Dict[str, Any]]) -> None:
+        """
+        Upload results in batches, marking each one uploaded in the spool as soon as it is.
+
+        @raise KiwiException: if any result could not be uploaded.
+        """
+        failures = 0
+        for start in range(0, len(results), KIWI_BATCH_SIZE):
+            batch = results[start : start + KIWI_BATCH_SIZE]
+            outcomes = await asyncio.gather(
+                *[self._upload_result(result) for result in batch],
+                return_exceptions=True,
             )
-            self.backend.add_test_case_to_plan(
-                kiwi_test_case["id"], self.backend.plan_id
+            for result, outcome in zip(batch, outcomes):
+                if isinstance(outcome, BaseException):
+                    logger.warning(
+                        "Unable to upload %s to Kiwi: %s", result["id"], outcome
+                    )
+                    failures += 1
+                else:
+                    self.spool.mark_uploaded(result["id"])
+        if failures:
+            raise KiwiException(f"{failures} of {len(results)} results not uploaded")
+
+    async def _upload_result(self, result: Dict[str, Any]) -> None:
+        status_id = self._status_map[result["state"]]
+        with metrics.kiwi_upload_seconds.labels().time():
+            executions = self._executions.get(result["summary"])
+            if executions is None:
+                executions = await self._register(result["summary"])
+            await asyncio.gather(
+                *[
+                    self._run_rpc(
+                        self._update_execution_sync,
+                        execution,
+                        status_id,
+                        result["comment"],
+                    )
+                    for execution in executions
+                ]
             )
-            self.backend.add_test_case_to_run(kiwi_test_case["id"], self.backend.run_id)
 
-    async def report_status(self, tl_test_case: TestCase) -> None:
-        await asyncio.to_thread(self._report_status, tl_test_case)
+    async def _register(self, summary: str) -> List[int]:
+        executions: List[int] = await self._run_rpc(self._register_sync, summary)
+        self._executions[summary] = executions
+        return executions
+
+    def _register_sync(self, summary: str) -> List[int]:
+        # ensure the test case exists in the given plan and run.
+        backend = self._thread_backend()
+        kiwi_test_case, _ = backend.test_case_get_or_create(summary)
+        backend.add_test_case_to_plan(kiwi_test_case["id"], backend.plan_id)
+        executions = backend.add_test_case_to_run(kiwi_test_case["id"], backend.run_id)
+        return [execution["id"] for execution in executions]
 
-    def _report_status(self, tl_test_case: TestCase) -> None:
-        status_id = self._status_map[tl_test_case.state]
-        kiwi_test_case, _ = self.backend.test_case_get_or_create(
-            summarize_test_case(tl_test_case)
+    def _update_execution_sync(
+        self, execution_id: int, status_id: int, comment: str
+    ) -> None:
+        self._thread_backend().update_test_execution(
+            execution_id, status_id, comment=comment
         )
-        executions = self.backend.add_test_case_to_run(
-            kiwi_test_case["id"], self.backend.run_id
+
+    async def _run_rpc(self, function: typing.Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
         )
-        comment = "Adapters:\n"
-        for name, adapter in tl_test_case.adapters.items():
-            adapter_details = (
-                f"{name} = {adapter.client.name} {adapter.client.registration}\n"
-            )
-            comment += adapter_details
 
-        comment += "Servers:\n"
-        for server in tl_test_case.servers:
-            server_details = f"{server.server_name} = {server.cs_api}"
-            comment += server_details
+    def _thread_backend(self) -> Backend:
+        backend: Optional[Backend] = getattr(self._thread_local, "backend", None)
+        if backend is None:
+            backend = copy.copy(self.backend)
+            backend.rpc = TCMS().exec
+            self._thread_local.backend = backend
+        return backend
 
-        for execution in executions:
-            self.backend.update_test_execution(
-                execution["id"], status_id, comment=comment
-            )
 
-    async def end_run(self) -> None:
-        await asyncio.to_thread(self._end_run_sync)
+async def replay(spool_path: str, verbose: bool) -> Tuple[int, int]:
+    """
+    Upload every result left in a spool to Kiwi, eg after Kiwi was down during a run.
 
-    def _end_run_sync(self) -> None:
-        self.backend.finish_test_run()
+    Results go to the run they were recorded against, or to a new run for their product,
+    version and build if trafficlight never reached Kiwi during that run.
+    @return: how many results were uploaded, and how many are still left in the spool.
+    """
+    spool = Spool(spool_path)
+    runs: Dict[str, List[Dict[str, Any]]] = {}
+    for result in spool.pending.values():
+        environment = dict(result["environment"])
+        if result.get("run_id") is not None:
+            environment["TCMS_RUN_ID"] = str(result["run_id"])
+        runs.setdefault(json.dumps(environment, sort_keys=True), []).append(result)
+
+    uploaded = 0
+    for environment_key, results in runs.items():
+        for name, value in json.loads(environment_key).items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        client = KiwiClient(verbose, spool)
+        try:
+            await client._run_rpc(client._configure)
+            await client._upload(results)
+            await client._run_rpc(client._end_run_sync)
+        except Exception:
+            logger.exception("Unable to replay %s results to Kiwi", len(results))
+        finally:
+            client._executor.shutdown(wait=False)
+        uploaded += len(results) - len(
+            [result for result in results if result["id"] in spool.pending]
+        )
+    await spool.close()
+    return uploaded, len(spool.pending)
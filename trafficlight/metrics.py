@@ -0,0 +1,319 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import math
+import time
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Dict,
+    Generic,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+# Upper bounds, in seconds, of the buckets durations are counted in; adapter actions
+# take anything from milliseconds to minutes.
+DEFAULT_BUCKETS: Sequence[float] = (
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+    600,
+)
+
+
+class Counter(object):
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Gauge(object):
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram(object):
+    """
+    Counts of observed values in fixed buckets, with their total; cheap to update and to read.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = buckets
+        # One count per bucket, plus one for values above the largest bucket.
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self) -> Optional[float]:
+        if self.count == 0:
+            return None
+        return self.sum / self.count
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        An upper bound for the q-quantile (eg 0.9) of the observed values, from the bucket it falls in.
+
+        @return: None if nothing was observed, or infinity if it falls above the largest bucket.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        """
+        Observe how many seconds the body of a with statement takes.
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started)
+
+
+M = TypeVar("M", Counter, Gauge, Histogram)
+
+
+class _Family(Generic[M]):
+    """
+    A metric for each combination of label values, eg one per action name and adapter type.
+
+    Every family is registered to be included in render().
+    """
+
+    metric_type = ""
+
+    def __init__(
+        self, name: str, documentation: str, label_names: Sequence[str] = ()
+    ) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self._metrics: Dict[Tuple[str, ...], M] = {}
+        _registry.append(self)
+
+    def _new_metric(self) -> M:
+        raise NotImplementedError()
+
+    def labels(self, *label_values: str) -> M:
+        metric = self._metrics.get(label_values)
+        if metric is None:
+            metric = self._new_metric()
+            self._metrics[label_values] = metric
+        return metric
+
+    def items(self) -> Iterable[Tuple[Tuple[str, ...], M]]:
+        return sorted(self._metrics.items())
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.metric_type}"
+        for label_values, metric in self.items():
+            yield from self._render_metric(
+                dict(zip(self.label_names, label_values)), metric
+            )
+
+    def _render_metric(self, labels: Dict[str, str], metric: M) -> Iterator[str]:
+        raise NotImplementedError()
+
+
+class CounterFamily(_Family[Counter]):
+    metric_type = "counter"
+
+    def _new_metric(self) -> Counter:
+        return Counter()
+
+    def _render_metric(self, labels: Dict[str, str], metric: Counter) -> Iterator[str]:
+        yield f"{self.name}{_format_labels(labels)} {_format_value(metric.value)}"
+
+
+class GaugeFamily(_Family[Gauge]):
+    metric_type = "gauge"
+
+    def _new_metric(self) -> Gauge:
+        return Gauge()
+
+    def _render_metric(self, labels: Dict[str, str], metric: Gauge) -> Iterator[str]:
+        yield f"{self.name}{_format_labels(labels)} {_format_value(metric.value)}"
+
+
+class HistogramFamily(_Family[Histogram]):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = buckets
+
+    def _new_metric(self) -> Histogram:
+        return Histogram(self.buckets)
+
+    def _render_metric(
+        self, labels: Dict[str, str], metric: Histogram
+    ) -> Iterator[str]:
+        cumulative = 0
+        for bound, count in zip(list(metric.buckets) + [math.inf], metric.counts):
+            cumulative += count
+            bucket_labels = {**labels, "le": _format_value(bound)}
+            yield f"{self.name}_bucket{_format_labels(bucket_labels)} {cumulative}"
+        yield f"{self.name}_sum{_format_labels(labels)} {_format_value(metric.sum)}"
+        yield f"{self.name}_count{_format_labels(labels)} {metric.count}"
+
+
+_registry: List["_Family[Any]"] = []
+
+
+def render() -> str:
+    """
+    Every registered metric, in the Prometheus text exposition format.
+
+    This only reads the current values, so costs the same however many test cases there are.
+    """
+    lines = [line for family in _registry for line in family.render()]
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{name}="{_escape(value)}"' for name, value in labels.items())
+    return "{" + ",".join(escaped) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+action_wait_seconds = HistogramFamily(
+    "trafficlight_action_wait_seconds",
+    "Time from a test queueing an action until an adapter picked it up.",
+    ("action", "adapter_type"),
+)
+action_duration_seconds = HistogramFamily(
+    "trafficlight_action_duration_seconds",
+    "Time from a test queueing an action until the adapter responded.",
+    ("action", "adapter_type"),
+)
+adapters = GaugeFamily(
+    "trafficlight_adapters",
+    "Registered adapters, by type and by state (available, busy or completed).",
+    ("type", "state"),
+)
+adapter_errors = CounterFamily(
+    "trafficlight_adapter_errors_total",
+    "Errors reported by or for adapters, including timeouts, by adapter type.",
+    ("type",),
+)
+test_cases = GaugeFamily(
+    "trafficlight_test_cases",
+    "Test cases in each state.",
+    ("state",),
+)
+waiting_test_cases = GaugeFamily(
+    "trafficlight_scheduler_waiting_test_cases",
+    "Test cases the last scheduling pass could not start, by why not.",
+    ("reason",),
+)
+http_request_seconds = HistogramFamily(
+    "trafficlight_adapter_request_seconds",
+    "Time to handle adapter requests (including any long-poll wait), by endpoint.",
+    ("endpoint",),
+)
+homerunner_create_seconds = HistogramFamily(
+    "trafficlight_homerunner_create_seconds",
+    "Time for homerunner to create a deployment.",
+)
+homeserver_ready_seconds = HistogramFamily(
+    "trafficlight_homeserver_ready_seconds",
+    "Time from a homeserver being created until it answered requests.",
+)
+kiwi_upload_seconds = HistogramFamily(
+    "trafficlight_kiwi_upload_seconds",
+    "Time to upload one test result to Kiwi.",
+)
+kiwi_pending_results = GaugeFamily(
+    "trafficlight_kiwi_pending_results",
+    "Test results in the Kiwi spool that have not been uploaded yet.",
+)
+artifact_uploads = CounterFamily(
+    "trafficlight_artifact_uploads_total",
+    "Files uploaded by adapters, by whether they were stored or were a duplicate of a stored file.",
+    ("result",),
+)
+artifact_store_bytes = GaugeFamily(
+    "trafficlight_artifact_store_bytes",
+    "Bytes of uploaded files being kept.",
+)
+render_cache = CounterFamily(
+    "trafficlight_status_render_cache_total",
+    "Status page requests, by whether the page was rendered (miss) or served from the cache (hit).",
+    ("result",),
+)
+background_loop_seconds = HistogramFamily(
+    "trafficlight_background_loop_seconds",
+    "Time for one iteration of a background loop, not counting time asleep.",
+    ("loop",),
+)
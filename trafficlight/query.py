@@ -0,0 +1,154 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Filtered, paginated views of the test suites, test cases and adapters in the store.
+
+Pages are fetched with a cursor: pass the next_cursor of one page to get the page after it.
+Cursors are positions in the order things were added, so a page is unaffected by anything
+added or removed before it.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import (
+    Callable,
+    Collection,
+    Generic,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from trafficlight.internals.adapter import Adapter
+from trafficlight.internals.testcase import TestCase
+from trafficlight.internals.testsuite import TestSuite
+from trafficlight.store import iter_adapters, iter_tests, iter_testsuites
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+T = TypeVar("T")
+
+
+@dataclass
+class Page(Generic[T]):
+    items: List[T]
+    # The cursor for the next page, or None if this is the last page.
+    next_cursor: Optional[int]
+
+
+def _page(
+    entries: Iterator[Tuple[int, T]], match: Callable[[T], bool], limit: int
+) -> Page[T]:
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items: List[T] = []
+    last_position = 0
+    for position, item in entries:
+        if not match(item):
+            continue
+        if len(items) == limit:
+            # There is at least one more; the next page starts after the last item on this one.
+            return Page(items, last_position)
+        items.append(item)
+        last_position = position
+    return Page(items, None)
+
+
+def _in_range(
+    value: datetime, since: Optional[datetime], until: Optional[datetime]
+) -> bool:
+    return (since is None or value >= since) and (until is None or value < until)
+
+
+def testsuites(
+    name: Optional[str] = None, cursor: int = 0, limit: int = DEFAULT_PAGE_SIZE
+) -> Page[TestSuite]:
+    """
+    @param name: only the suite with this name.
+    """
+    return _page(
+        iter_testsuites(cursor),
+        lambda testsuite: name is None or testsuite.name() == name,
+        limit,
+    )
+
+
+def test_cases(
+    states: Collection[str] = (),
+    client_type: Optional[str] = None,
+    suite: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: int = 0,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> Page[TestCase]:
+    """
+    @param states: only test cases in one of these states; all states if empty.
+    @param client_type: only test cases with a client of this type, by name (eg ElementWebStable)
+        or by adapter type (eg element-web).
+    @param suite: only test cases in the suite with this name.
+    @param since: only test cases that last changed state at or after this time.
+    @param until: only test cases that last changed state before this time.
+    """
+
+    def match(test_case: TestCase) -> bool:
+        if states and test_case.state not in states:
+            return False
+        if suite is not None and test_case.test.name() != suite:
+            return False
+        if client_type is not None and not any(
+            client_type
+            in (test_case_client_type.name(), test_case_client_type.adapter_type)
+            for test_case_client_type in test_case.client_types.values()
+        ):
+            return False
+        return _in_range(test_case.transitions[-1][1], since, until)
+
+    return _page(iter_tests(cursor), match, limit)
+
+
+def adapters(
+    states: Collection[str] = (),
+    client_type: Optional[str] = None,
+    suite: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: int = 0,
+    limit: int = DEFAULT_PAGE_SIZE,
+) -> Page[Adapter]:
+    """
+    @param states: only adapters in one of these states (available, busy or completed); all if empty.
+    @param client_type: only adapters that registered with this type, eg element-web.
+    @param suite: only adapters allocated to a test case in the suite with this name.
+    @param since: only adapters that registered at or after this time.
+    @param until: only adapters that registered before this time.
+    """
+
+    def match(adapter: Adapter) -> bool:
+        if states and adapter.state() not in states:
+            return False
+        if (
+            client_type is not None
+            and str(adapter.registration.get("type")) != client_type
+        ):
+            return False
+        if suite is not None and (
+            adapter.client is None or adapter.client.test_case.test.name() != suite
+        ):
+            return False
+        return _in_range(adapter.registered, since, until)
+
+    return _page(iter_adapters(cursor), match, limit)
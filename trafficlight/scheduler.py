@@ -0,0 +1,286 @@
+# vim: expandtab ts=4:
+# Copyright 2022 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import annotations
+
+import asyncio
+import logging
+import typing
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+if typing.TYPE_CHECKING:
+    from trafficlight.homerunner import HomerunnerClient
+    from trafficlight.internals.adapter import Adapter, AdapterPool
+    from trafficlight.internals.testcase import TestCase
+
+logger = logging.getLogger(__name__)
+
+# If nothing has notified the scheduler in this long, sweep anyway; this catches
+# any change in state that doesn't go through notify().
+FALLBACK_SWEEP_SECONDS = 30
+
+# Why a test case could not be started, as given in SchedulingPass.unplaced.
+NO_FREE_ADAPTER = "no free adapter"
+ADAPTERS_ALLOCATED = "free adapters are allocated to other test cases"
+NO_HOMESERVER_CAPACITY = "waiting for homeserver capacity"
+
+_wakeup = asyncio.Event()
+_pending_reasons: Dict[str, int] = {}
+
+
+def notify(reason: str) -> None:
+    """
+    Ask the scheduler to look for test cases to start as soon as possible.
+
+    Call this whenever something happens that may let a waiting test case start, eg
+    an adapter registering or completing, a test case finishing or a homeserver becoming ready.
+    Multiple notifications before the scheduler wakes are coalesced into a single pass.
+    """
+    logger.debug("Scheduler notified: %s", reason)
+    _pending_reasons[reason] = _pending_reasons.get(reason, 0) + 1
+    _wakeup.set()
+
+
+async def wait_for_events(timeout: float = FALLBACK_SWEEP_SECONDS) -> Dict[str, int]:
+    """
+    Wait until notify() is called, or until timeout seconds pass.
+
+    @return: the reasons passed to notify() since the last call, with how often each was given.
+    """
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
+    reasons = dict(_pending_reasons)
+    _pending_reasons.clear()
+    return reasons
+
+
+@dataclass
+class SchedulingPass:
+    """
+    The outcome of one scheduling pass over the waiting test cases.
+    """
+
+    # Test cases that were allocated adapters, with the adapters each one got.
+    allocations: List[typing.Tuple[TestCase, Dict[str, Adapter]]] = field(
+        default_factory=list
+    )
+    # Test cases that are still waiting, with why they could not be placed.
+    unplaced: Dict[TestCase, str] = field(default_factory=dict)
+    # How many test cases could not be placed for each reason, without the details.
+    unplaced_reasons: Dict[str, int] = field(default_factory=dict)
+
+    def add_unplaced(self, test_case: TestCase, reason: str, details: str = "") -> None:
+        self.unplaced[test_case] = reason + details
+        self.unplaced_reasons[reason] = self.unplaced_reasons.get(reason, 0) + 1
+
+    def summary(self) -> str:
+        return f"started {len(self.allocations)} test cases, {len(self.unplaced)} still waiting: {self.unplaced_reasons}"
+
+
+# A client slot is one client variable of one test case, eg (test_case, "alice")
+_Slot = typing.Tuple["TestCase", str]
+_BucketKey = typing.Tuple[str, str]
+
+
+class AdapterMatching:
+    """
+    A bipartite matching of test case clients to the buckets of an AdapterPool.
+
+    Adapters in a bucket are interchangeable, so clients are matched to buckets with
+    a capacity of the bucket's size, and concrete adapters are only picked once matching
+    is done. This keeps a pass cheap however many adapters of one type are registered.
+
+    Test cases are added one at a time; a test case is only accepted if every one of
+    its clients can be matched at the same time. Adding a test case may move clients
+    of previously accepted test cases onto other buckets (along an augmenting path)
+    to make room, so overlapping client types (eg ElementWebStable and ElementWebDevelop
+    both accepting element-web adapters) never cause a test case to be rejected
+    while a valid allocation exists.
+    """
+
+    def __init__(self, pool: AdapterPool) -> None:
+        self.pool = pool
+        self._free: Dict[_BucketKey, int] = {}
+        self._assignment: Dict[_Slot, _BucketKey] = {}
+        self._slots: Dict[_BucketKey, List[_Slot]] = {}
+        self._allocations: Optional[Dict[TestCase, Dict[str, Adapter]]] = None
+        self.test_cases: List[TestCase] = []
+
+    def add(self, test_case: TestCase) -> bool:
+        """
+        Try to match all clients of test_case, keeping every previously added test case matched.
+
+        @return: True if the test case was added; False (leaving the matching unchanged) otherwise.
+        """
+        journal: List[typing.Tuple[_Slot, Optional[_BucketKey], _BucketKey]] = []
+        for client_var_name in test_case.client_types.keys():
+            if not self._augment((test_case, client_var_name), journal):
+                self._rollback(journal)
+                return False
+        self.test_cases.append(test_case)
+        self._allocations = None
+        return True
+
+    def fits(self, test_case: TestCase) -> bool:
+        """
+        Whether add() would accept test_case, leaving the matching unchanged either way.
+        """
+        journal: List[typing.Tuple[_Slot, Optional[_BucketKey], _BucketKey]] = []
+        try:
+            return all(
+                self._augment((test_case, client_var_name), journal)
+                for client_var_name in test_case.client_types.keys()
+            )
+        finally:
+            self._rollback(journal)
+
+    def allocation(self, test_case: TestCase) -> Dict[str, Adapter]:
+        if self._allocations is None:
+            self._allocations = self._pick_adapters()
+        return self._allocations[test_case]
+
+    def _candidates(self, slot: _Slot) -> List[_BucketKey]:
+        test_case, client_var_name = slot
+        keys = self.pool.bucket_keys(
+            test_case.client_types[client_var_name].adapter_type
+        )
+        for key in keys:
+            if key not in self._free:
+                self._free[key] = self.pool.bucket_size(key)
+                self._slots[key] = []
+        return keys
+
+    def _augment(
+        self,
+        start: _Slot,
+        journal: List[typing.Tuple[_Slot, Optional[_BucketKey], _BucketKey]],
+    ) -> bool:
+        # Breadth-first search for an augmenting path from an unmatched slot to a bucket with room.
+        parent_slot: Dict[_BucketKey, _Slot] = {}
+        queue = deque([start])
+        while queue:
+            slot = queue.popleft()
+            for key in self._candidates(slot):
+                if key in parent_slot:
+                    continue
+                parent_slot[key] = slot
+                if self._free[key] == 0:
+                    # Full, but any slot using this bucket could move elsewhere.
+                    queue.extend(self._slots[key])
+                    continue
+                # Found room; shift each slot along the path onto its new bucket.
+                self._free[key] -= 1
+                next_key: Optional[_BucketKey] = key
+                while next_key is not None:
+                    path_slot = parent_slot[next_key]
+                    previous_key = self._assignment.get(path_slot)
+                    self._move(path_slot, previous_key, next_key)
+                    journal.append((path_slot, previous_key, next_key))
+                    next_key = previous_key
+                return True
+        return False
+
+    def _move(
+        self, slot: _Slot, from_key: Optional[_BucketKey], to_key: Optional[_BucketKey]
+    ) -> None:
+        if from_key is not None:
+            self._slots[from_key].remove(slot)
+        if to_key is not None:
+            self._slots[to_key].append(slot)
+            self._assignment[slot] = to_key
+        else:
+            del self._assignment[slot]
+
+    def _rollback(
+        self, journal: List[typing.Tuple[_Slot, Optional[_BucketKey], _BucketKey]]
+    ) -> None:
+        for slot, previous_key, key in reversed(journal):
+            self._move(slot, key, previous_key)
+        for _, _, key in journal:
+            self._free[key] = self.pool.bucket_size(key) - len(self._slots[key])
+
+    def _pick_adapters(self) -> Dict[TestCase, Dict[str, Adapter]]:
+        allocations: Dict[TestCase, Dict[str, Adapter]] = {
+            test_case: {} for test_case in self.test_cases
+        }
+        for key, slots in self._slots.items():
+            for (test_case, client_var_name), adapter in zip(
+                slots, self.pool.bucket(key)
+            ):
+                allocations[test_case][client_var_name] = adapter
+        return allocations
+
+
+def _add_unplaced(
+    result: SchedulingPass, test_case: TestCase, pool: AdapterPool
+) -> None:
+    missing = [
+        f"{client_var_name} ({client_type})"
+        for client_var_name, client_type in test_case.client_types.items()
+        if not pool.bucket_keys(client_type.adapter_type)
+    ]
+    if missing:
+        result.add_unplaced(test_case, NO_FREE_ADAPTER, " for " + ", ".join(missing))
+    else:
+        result.add_unplaced(test_case, ADAPTERS_ALLOCATED)
+
+
+def plan(
+    test_cases: List[TestCase],
+    pool: AdapterPool,
+    homerunner: Optional[HomerunnerClient] = None,
+) -> SchedulingPass:
+    """
+    Allocate adapters to as many waiting test cases as will fit.
+
+    Test cases needing fewer clients are considered first, as a heuristic for placing more
+    test cases on the pool; test cases needing the same number keep their waiting order.
+    The allocations never share an adapter.
+    @param test_cases: test cases to consider; only those in the "waiting" state are allocated.
+    @param pool: adapters that are free to be allocated.
+    @param homerunner: if given, test cases are only allocated while it has capacity for their
+        homeservers, and that capacity is reserved for each allocated test case. Unclaimed
+        warm deployments are torn down to make room for test cases that only lack capacity.
+    """
+    waiting = [test_case for test_case in test_cases if test_case.state == "waiting"]
+    matching = AdapterMatching(pool)
+    over_capacity = set()
+    if len(pool) > 0:
+        for test_case in sorted(waiting, key=lambda tc: len(tc.client_types)):
+            server_type = test_case.server_type
+            if homerunner is None or server_type is None:
+                matching.add(test_case)
+            elif not homerunner.can_admit(server_type):
+                over_capacity.add(test_case)
+                if matching.fits(test_case):
+                    # Only homeservers are missing; don't let idle warm deployments hold them up.
+                    homerunner.reclaim_capacity(server_type)
+            elif matching.add(test_case):
+                homerunner.reserve(test_case.guid, server_type)
+
+    result = SchedulingPass()
+    placed = set(matching.test_cases)
+    for test_case in waiting:
+        if test_case in placed:
+            result.allocations.append((test_case, matching.allocation(test_case)))
+        elif test_case in over_capacity:
+            result.add_unplaced(test_case, NO_HOMESERVER_CAPACITY)
+        else:
+            _add_unplaced(result, test_case, pool)
+    return result
@@ -0,0 +1,129 @@
+// Keeps a status page up to date from the /status/events stream, rather than reloading it.
+//
+// Included with data-events, the stream to follow. A test case page also sets data-test-case
+// (the page is reloaded when that test case changes state, as so much of it depends on the
+// state) and data-file-url; the index page sets data-case-url for linking adapters to test cases.
+(function () {
+    "use strict";
+
+    const options = document.currentScript.dataset;
+    const source = new EventSource(options.events);
+
+    function each(selector, update) {
+        document.querySelectorAll(selector).forEach(update);
+    }
+
+    function addCell(row, content) {
+        const cell = row.insertCell();
+        if (content instanceof Node) {
+            cell.appendChild(content);
+        } else if (content !== null && content !== undefined) {
+            cell.textContent = content;
+        }
+        return cell;
+    }
+
+    function link(href, text) {
+        const element = document.createElement("a");
+        element.href = href;
+        element.textContent = text;
+        return element;
+    }
+
+    function reload() {
+        source.close();
+        window.location.reload();
+    }
+
+    // Sent when this page missed events, eg after a restart; start again from the current state.
+    source.addEventListener("reset", reload);
+
+    source.addEventListener("test_case", function (event) {
+        const data = JSON.parse(event.data);
+        if (data.test_case === options.testCase) {
+            reload();
+            return;
+        }
+        each('[data-test-state="' + data.test_case + '"]', function (element) {
+            element.textContent = data.state;
+        });
+        each('[data-suite-count="' + data.suite + '"]', function (element) {
+            const states = element.dataset.states.split(" ");
+            let count = parseInt(element.textContent, 10);
+            if (states.includes(data.previous)) {
+                count -= 1;
+            }
+            if (states.includes(data.state)) {
+                count += 1;
+            }
+            element.textContent = count;
+        });
+    });
+
+    source.addEventListener("adapter", function (event) {
+        const data = JSON.parse(event.data);
+        const state = data.error ? data.state + ": " + data.error : data.state;
+        each('[data-adapter-state="' + data.adapter + '"]', function (element) {
+            element.textContent = state;
+        });
+        each('[data-adapter-error="' + data.adapter + '"]', function (element) {
+            element.textContent = data.error || "";
+        });
+
+        // The index page lists every adapter, in progress then completed.
+        const inProgress = document.getElementById("inprogress-adapters");
+        if (inProgress === null) {
+            return;
+        }
+        let row = document.getElementById("adapter-" + data.adapter);
+        if (data.state === "removed") {
+            if (row !== null) {
+                row.remove();
+            }
+            return;
+        }
+        if (row === null) {
+            row = inProgress.insertRow();
+            row.id = "adapter-" + data.adapter;
+            addCell(row, data.adapter);
+            addCell(row, state).dataset.adapterState = data.adapter;
+            addCell(row, null);
+            addCell(row, null);
+            addCell(row, data.type);
+        }
+        const testCaseCell = row.cells[2];
+        testCaseCell.textContent = "";
+        if (data.test_case) {
+            testCaseCell.appendChild(link(options.caseUrl.replace("__guid__", data.test_case), data.client));
+        }
+        if (data.state === "completed") {
+            const completed = document.getElementById("completed-adapters");
+            completed.insertBefore(row, completed.firstChild);
+        }
+    });
+
+    source.addEventListener("file", function (event) {
+        const data = JSON.parse(event.data);
+        const files = document.getElementById("files");
+        if (files === null) {
+            return;
+        }
+        const row = files.insertRow();
+        addCell(row, data.name);
+        addCell(row, link(options.fileUrl.replace("__name__", encodeURIComponent(data.name)), "Download"));
+    });
+
+    source.addEventListener("action", function (event) {
+        const data = JSON.parse(event.data);
+        const actions = document.getElementById("actions");
+        if (actions === null) {
+            return;
+        }
+        const row = actions.insertRow();
+        addCell(row, data.client);
+        addCell(row, data.action);
+        addCell(row, data.waited === null ? null : data.waited.toFixed(2));
+        addCell(row, data.took.toFixed(2));
+        addCell(row, data.error ? "Error" : null);
+    });
+})();
@@ -12,20 +12,31 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import bisect
 import logging
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-from trafficlight.internals.adapter import Adapter
-from trafficlight.internals.testcase import TestCase
+from trafficlight.internals.adapter import Adapter, AdapterPool
+from trafficlight.internals.testcase import StateCounts, TestCase
 from trafficlight.internals.testsuite import TestSuite
 
 logger = logging.getLogger(__name__)
 
 _adapters: List[Adapter] = []
+_adapters_by_guid: Dict[str, Adapter] = {}
+# A number for each registered adapter, increasing in the order they registered.
+_adapter_sequence: Dict[str, int] = {}
+_last_adapter_sequence = 0
+
+# Adapters that are free to be allocated, kept up to date by the adapters themselves.
+_available_adapters = AdapterPool()
 
 _testsuites: Dict[str, TestSuite] = {}
 
 _testcases: List[TestCase] = []
+_testcases_by_guid: Dict[str, TestCase] = {}
+# States of every test case in every suite.
+_state_counts = StateCounts()
 
 
 def get_testsuites() -> List[TestSuite]:
@@ -40,11 +51,41 @@ def get_tests() -> List[TestCase]:
     return _testcases
 
 
+def iter_tests(after: int = 0) -> Iterator[Tuple[int, TestCase]]:
+    """
+    Test cases in the order they were added, each with its position (counting from 1).
+
+    @param after: skip test cases up to and including this position.
+    """
+    for index in range(after, len(_testcases)):
+        yield index + 1, _testcases[index]
+
+
+def iter_testsuites(after: int = 0) -> Iterator[Tuple[int, TestSuite]]:
+    """
+    Test suites in the order they were added, each with its position (counting from 1).
+
+    @param after: skip test suites up to and including this position.
+    """
+    testsuites = list(_testsuites.values())
+    for index in range(after, len(testsuites)):
+        yield index + 1, testsuites[index]
+
+
+def get_artifacts_in_use() -> Set[str]:
+    """
+    Digests of the files uploaded for test cases that have not finished, which must be kept.
+    """
+    return {
+        artifact.digest
+        for test_case in _testcases
+        if not test_case.state.finished()
+        for artifact in test_case.files.values()
+    }
+
+
 def get_test_case(guid: str) -> Optional[TestCase]:
-    for test in _testcases:
-        if str(test.guid) == str(guid):
-            return test
-    return None
+    return _testcases_by_guid.get(guid)
 
 
 def add_testsuite(testsuite: TestSuite) -> None:
@@ -53,6 +94,13 @@ def add_testsuite(testsuite: TestSuite) -> None:
 
     _testsuites[testsuite.guid] = testsuite
     _testcases.extend(testsuite.test_cases or [])
+    for test_case in testsuite.test_cases or []:
+        _testcases_by_guid[test_case.guid] = test_case
+        _state_counts.add(test_case)
+
+
+def get_state_counts() -> StateCounts:
+    return _state_counts
 
 
 def get_adapters(completed: bool = None) -> List[Adapter]:
@@ -65,16 +113,45 @@ def get_adapters(completed: bool = None) -> List[Adapter]:
         return list(filter(lambda x: not x.completed, _adapters))
 
 
+def iter_adapters(after: int = 0) -> Iterator[Tuple[int, Adapter]]:
+    """
+    Registered adapters in the order they registered, each with its sequence number.
+
+    Sequence numbers are never reused, so they stay valid as adapters are removed.
+    @param after: skip adapters up to and including this sequence number.
+    """
+    index = bisect.bisect_right(
+        _adapters, after, key=lambda adapter: _adapter_sequence[adapter.guid]
+    )
+    while index < len(_adapters):
+        adapter = _adapters[index]
+        yield _adapter_sequence[adapter.guid], adapter
+        index += 1
+
+
 def get_adapter(guid: str) -> Optional[Adapter]:
-    for adapter in get_adapters():
-        if adapter.guid == guid:
-            return adapter
-    return None
+    return _adapters_by_guid.get(guid)
+
+
+def get_available_adapters() -> AdapterPool:
+    return _available_adapters
 
 
 def add_adapter(adapter: Adapter) -> None:
+    global _last_adapter_sequence
+    _last_adapter_sequence += 1
+    _adapter_sequence[adapter.guid] = _last_adapter_sequence
     _adapters.append(adapter)
+    _adapters_by_guid[adapter.guid] = adapter
+    adapter.pool = _available_adapters
+    _available_adapters.update(adapter)
+    adapter.track_state()
 
 
 def remove_adapter(adapter: Adapter) -> None:
     _adapters.remove(adapter)
+    _adapters_by_guid.pop(adapter.guid, None)
+    _adapter_sequence.pop(adapter.guid, None)
+    _available_adapters.discard(adapter)
+    adapter.pool = None
+    adapter.track_state(registered=False)